@@ -12,11 +12,20 @@ endfunc
 call s:opt('ncm2#auto_popup', 1)
 call s:opt('ncm2#complete_delay', 0)
 call s:opt('ncm2#popup_delay', 60)
+call s:opt('ncm2#popup_delay_adaptive', 0)
+call s:opt('ncm2#popup_delay_max', 150)
 call s:opt('ncm2#complete_length', [[1,3],[7,2]])
 call s:opt('ncm2#matcher', 'abbrfuzzy')
 call s:opt('ncm2#sorter', 'abbrfuzzy')
 call s:opt('ncm2#filter', [])
 call s:opt('ncm2#popup_limit', -1)
+call s:opt('ncm2#total_popup_limit', -1)
+call s:opt('ncm2#popup_delta', 1)
+call s:opt('ncm2#stats', 0)
+call s:opt('ncm2#parallel_threshold', -1)
+call s:opt('ncm2#parallel_workers', 0)
+call s:opt('ncm2#filter_budget', 0)
+call s:opt('ncm2#complete_append_interval', 100)
 
 let g:ncm2#core_data = {}
 let g:ncm2#core_event = []
@@ -32,6 +41,9 @@ inoremap <silent> <Plug>(ncm2_manual_trigger) <C-r>=ncm2#_on_complete(1)<CR>
 inoremap <silent> <Plug>(ncm2_complete_popup) <C-r>=ncm2#_real_popup()<CR>
 inoremap <silent> <Plug>(_ncm2_auto_trigger) <C-r>=ncm2#_on_complete(0)<CR>
 
+command! -nargs=? -complete=customlist,ncm2#_stats_complete Ncm2Stats
+            \ call ncm2#stats(<f-args>)
+
 let s:core = yarp#py3('ncm2_core')
 let s:core.on_load = 'ncm2#_core_started'
 let s:sources = {}
@@ -39,11 +51,17 @@ let s:sources_override = {}
 let s:popup_timer = 0
 let s:popup_timer_args = []
 let s:popup_timer_tick = []
+let s:popup_timer_start = []
 let s:complete_timer = 0
+let s:append_timer = 0
+let s:append_time = []
 let s:lock = {}
 let s:startbcol = 1
 let s:lnum = 0
 let s:matches = []
+let s:received = []
+let s:received_seq = -1
+let s:complete_times = []
 let s:subscope_detectors = {}
 let s:auto_trigger_tick = []
 let s:skip_tick = []
@@ -51,12 +69,28 @@ let s:skip_context_id = 0
 let s:context_tick_extra = 0
 let s:context_id = 0
 let s:completion_notified = {}
+let s:lines_changed = {}
+
+" the core keeps a mirror of the buffer for subscope detection. neovim
+" pushes the changed lines to the core with nvim_buf_attach, vim8 sends the
+" changed lines collected by listener_add, otherwise the whole buffer is
+" sent.
+if has('nvim')
+    let s:lines_sync = 'attach'
+elseif exists('*listener_add')
+    let s:lines_sync = 'listener'
+else
+    let s:lines_sync = ''
+endif
 
 augroup ncm2_hooks
     au!
     au User Ncm2EnableForBuffer call s:warmup()
     au User Ncm2CoreData,Ncm2PopupClose,Ncm2PopupOpen silent 
     au FileType * call s:try_rnotify('load_plugin', &rtp)
+    if s:lines_sync == 'listener'
+        au BufUnload * call s:lines_unload(str2nr(expand('<abuf>')))
+    endif
 augroup END
 
 func! ncm2#enable_for_buffer()
@@ -232,25 +266,51 @@ func! ncm2#context(name)
 endfunc
 
 func! ncm2#complete(ctx, startccol, matches, ...)
-    let refresh = 0
-    if len(a:000)
-        let refresh = a:1
-    endif
+    let refresh = get(a:000, 0, 0)
+    let append = get(a:000, 1, 0)
 
     let dated = s:context_tick() != a:ctx.tick
     let a:ctx.dated = dated
 
+    let popup = append ? s:append_popup_due() : 1
+
     call s:try_rnotify('complete',
             \   a:ctx,
             \   a:startccol,
             \   a:matches,
-            \   refresh)
+            \   refresh,
+            \   append,
+            \   popup)
 
     if dated && refresh
         call ncm2#_on_complete(2)
     endif
 endfunc
 
+" the popup is updated at most once per g:ncm2#complete_append_interval for
+" the appended matches, a skipped update is done by the timer
+func! s:append_popup_due()
+    if s:append_timer
+        return 0
+    endif
+    let elapsed = empty(s:append_time) ? g:ncm2#complete_append_interval :
+                \ reltimefloat(reltime(s:append_time)) * 1000
+    if elapsed >= g:ncm2#complete_append_interval
+        let s:append_time = reltime()
+        return 1
+    endif
+    let s:append_timer = timer_start(
+                \ float2nr(g:ncm2#complete_append_interval - elapsed),
+                \ {_ -> s:append_popup() })
+    return 0
+endfunc
+
+func! s:append_popup()
+    let s:append_timer = 0
+    let s:append_time = reltime()
+    call s:try_rnotify('complete_popup')
+endfunc
+
 func! ncm2#context_dated(ctx)
     return a:ctx.context_id < get(s:completion_notified, a:ctx.source.name, 0)
 endfunc
@@ -273,21 +333,81 @@ func! ncm2#unlock(name)
     endif
 endfunc
 
-func! ncm2#_update_matches(ctx, startbcol, matches)
-    if g:ncm2#popup_delay
-        let s:popup_timer_args = [a:ctx, a:startbcol, a:matches]
-        if s:popup_timer
-            if s:popup_timer_tick == a:ctx.tick
+" wait is the milliseconds until the pending sources are late, -1 if it's
+" unknown. With the optional seq and base, matches is a delta against the
+" list received with seq base, or the whole list if base is -1.
+func! ncm2#_update_matches(ctx, startbcol, matches, ...)
+    let matches = a:matches
+    let wait = get(a:000, 0, -1)
+    if a:0 > 1
+        let [seq, base] = a:000[1:2]
+        if base >= 0
+            if base != s:received_seq
+                let s:received_seq = -1
+                call s:try_rnotify('popup_resync')
                 return
             endif
-            let s:popup_timer_tick = a:ctx.tick
-            call timer_stop(s:popup_timer)
+            let matches = s:matches_apply_delta(s:received, matches)
         endif
-        let s:popup_timer = timer_start(g:ncm2#popup_delay,
-                    \ funcref('s:popup_timed'))
+        let s:received = matches
+        let s:received_seq = seq
+    endif
+
+    if !g:ncm2#popup_delay
+        call ncm2#_real_update_matches(a:ctx, a:startbcol, matches)
+        return
+    endif
+
+    let s:popup_timer_args = [a:ctx, a:startbcol, matches]
+    let typing = s:popup_timer_tick != a:ctx.tick
+    if typing
+        let s:popup_timer_tick = a:ctx.tick
+        let s:popup_timer_start = reltime()
+    endif
+    let adaptive = s:popup_adaptive(wait)
+    if s:popup_timer && !typing && !adaptive
+        return
+    endif
+
+    let delay = adaptive ? wait : g:ncm2#popup_delay
+
+    if s:popup_timer
+        call timer_stop(s:popup_timer)
+        let s:popup_timer = 0
+    endif
+    if delay
+        let s:popup_timer = timer_start(delay, funcref('s:popup_timed'))
     else
-        call ncm2#_real_update_matches(a:ctx, a:startbcol, a:matches)
+        call ncm2#_real_update_matches(a:ctx, a:startbcol, matches)
+    endif
+endfunc
+
+" wait for the pending sources instead of g:ncm2#popup_delay, if they are
+" expected to answer within g:ncm2#popup_delay_max since the first update
+" of the typing
+func! s:popup_adaptive(wait)
+    if !g:ncm2#popup_delay_adaptive || a:wait < 0
+        return 0
     endif
+    let elapsed = reltimefloat(reltime(s:popup_timer_start)) * 1000
+    return a:wait + elapsed <= g:ncm2#popup_delay_max
+endfunc
+
+" each item of the delta is the index of an unchanged item in the old list,
+" [index, changed fields], or a new item
+func! s:matches_apply_delta(old, delta)
+    let matches = []
+    for e in a:delta
+        if type(e) == v:t_number
+            call add(matches, a:old[e])
+        elseif type(e) == v:t_list
+            call add(matches, extend(copy(a:old[e[0]]), e[1]))
+        else
+            call add(matches, e)
+        endif
+        unlet e
+    endfor
+    return matches
 endfunc
 
 func! s:popup_timed(_)
@@ -345,10 +465,38 @@ func! ncm2#_real_popup()
     endif
 
     doau <nomodeline> User Ncm2PopupOpen
-    call complete(s:startbcol, s:matches)
+    if g:ncm2#stats
+        let start = reltime()
+        call complete(s:startbcol, s:matches)
+        call add(s:complete_times, reltimefloat(reltime(start)))
+    else
+        call complete(s:startbcol, s:matches)
+    endif
     return ''
 endfunc
 
+func! ncm2#stats(...)
+    let cmd = get(a:000, 0, '')
+    if cmd == 'on'
+        let g:ncm2#stats = 1
+        call s:try_rnotify('stats_reset')
+    elseif cmd == 'off'
+        let g:ncm2#stats = 0
+        let s:complete_times = []
+    elseif cmd == 'reset'
+        let s:complete_times = []
+        call s:try_rnotify('stats_reset')
+    elseif cmd == ''
+        echo join(s:request('stats_get'), "\n")
+    else
+        echoerr 'Ncm2Stats: invalid argument ' . cmd
+    endif
+endfunc
+
+func! ncm2#_stats_complete(arg, ...)
+    return filter(['on', 'off', 'reset'], 'v:val =~ "^" . a:arg')
+endfunc
+
 func! ncm2#skip_auto_trigger()
     call s:cache_matches_cleanup()
     " invalidate s:update_matches
@@ -490,25 +638,106 @@ func! ncm2#_core_data(event)
                 \ 'sorter': g:ncm2#sorter,
                 \ 'filter': g:ncm2#filter,
                 \ 'popup_limit': g:ncm2#popup_limit,
+                \ 'total_popup_limit': g:ncm2#total_popup_limit,
+                \ 'popup_delta': g:ncm2#popup_delta,
+                \ 'popup_delay_adaptive': g:ncm2#popup_delay_adaptive,
+                \ 'stats': g:ncm2#stats,
+                \ 'parallel_threshold': g:ncm2#parallel_threshold,
+                \ 'parallel_workers': g:ncm2#parallel_workers,
+                \ 'filter_budget': g:ncm2#filter_budget,
                 \ 'context': s:context(),
                 \ 'sources': s:sources,
                 \ 'subscope_detectors': s:subscope_detectors,
+                \ 'lines_sync': s:lines_sync,
                 \ 'lines': []
                 \ }, 'force')
 
-    " if subscope detector is available for this buffer, we need to send
-    " the whole buffer for on_complete event
+    if g:ncm2#stats && !empty(s:complete_times) &&
+                \ (a:event == 'on_complete' ||
+                \ a:event == 'complete' ||
+                \ a:event == 'stats_get')
+        let data.complete_times = s:complete_times
+        let s:complete_times = []
+    endif
+
+    " if subscope detector is available for this buffer, the core needs
+    " the buffer content for on_complete event
     if has_key(s:subscope_detectors, &filetype) &&
                 \ (a:event == 'on_complete' ||
                 \ a:event == 'get_context' ||
                 \ a:event == 'on_warmup' ||
                 \ a:event == 'on_complete_done')
-        let data.lines = getline(1, '$')
+        if s:lines_sync == 'listener'
+            let data.lines_delta = s:lines_delta()
+        elseif s:lines_sync == ''
+            let data.lines = getline(1, '$')
+        endif
     endif
 
     return data
 endfunc
 
+" The lines changed since the last call, as a replacement of the lines
+" between the first unchanged lines and the last unchanged lines of the
+" buffer.  base is the changedtick the core's mirror should have, -1 means
+" the whole buffer is sent.
+func! s:lines_delta()
+    if !exists('b:ncm2_listener')
+        let b:ncm2_listener = listener_add(function('s:on_lines_changed'))
+    endif
+    call listener_flush()
+
+    let bufnr = bufnr('%')
+    let cnt = line('$')
+    let changed = get(s:lines_changed, bufnr, {})
+    let s:lines_changed[bufnr] = {
+                \ 'tick': b:changedtick,
+                \ 'first': cnt,
+                \ 'suffix': cnt}
+
+    if empty(changed)
+        return {'base': -1,
+                    \ 'tick': b:changedtick,
+                    \ 'first': 0,
+                    \ 'suffix': 0,
+                    \ 'lines': getline(1, '$')}
+    endif
+
+    let first = min([changed.first, cnt])
+    let suffix = max([min([changed.suffix, cnt - first]), 0])
+    return {'base': changed.tick,
+                \ 'tick': b:changedtick,
+                \ 'first': first,
+                \ 'suffix': suffix,
+                \ 'lines': getline(first + 1, cnt - suffix)}
+endfunc
+
+func! s:on_lines_changed(bufnr, start, end, added, changes)
+    let changed = get(s:lines_changed, a:bufnr, {})
+    if empty(changed)
+        return
+    endif
+    if a:bufnr != bufnr('%')
+        " the line count is unknown, send the whole buffer next time
+        let s:lines_changed[a:bufnr] = {}
+        return
+    endif
+    " walk backwards from the final line count
+    let cnt = line('$')
+    for c in reverse(copy(a:changes))
+        let changed.first = min([changed.first, c.lnum - 1])
+        let changed.suffix = min([changed.suffix, cnt - (c.end - 1 + c.added)])
+        let cnt -= c.added
+    endfor
+endfunc
+
+func! s:lines_unload(bufnr)
+    if has_key(s:lines_changed, a:bufnr)
+        unlet s:lines_changed[a:bufnr]
+        call s:core.try_notify('lines_unload', {}, a:bufnr)
+    endif
+endfunc
+
 func! s:try_rnotify(event, ...)
     let g:ncm2#core_event = [a:event, a:000]
     let g:ncm2#core_data = {}
@@ -0,0 +1,352 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmarks of the matchers and sorters.
+
+Typing is simulated one keystroke at a time against generated corpora, the
+same way the core matches a source's cached matches. The latency of each
+keystroke, the throughput and the memory allocated are reported.
+
+    python3 bench/bench.py
+    python3 bench/bench.py --quick --save result.json
+    python3 bench/bench.py --compare baseline.json
+
+The pythonx directory of ncm2 is added to sys.path, the neovim python
+client needs to be installed for importing ncm2.
+"""
+
+import sys
+import json
+import time
+import random
+import platform
+import argparse
+import tracemalloc
+from os import path
+
+sys.path.insert(0, path.join(path.dirname(path.abspath(__file__)),
+                             '..', 'pythonx'))
+
+from ncm2 import (matcher_get, matcher_many, MatchInfos,  # noqa: E402
+                  MatchIndex)
+from importlib import import_module  # noqa: E402
+
+SYLLABLES = ['get', 'set', 'buf', 'line', 'col', 'pos', 'ctx', 'match',
+             'sort', 'item', 'list', 'str', 'node', 'tree', 'key', 'val',
+             'index', 'cache', 'file', 'path', 'name', 'type', 'info',
+             'abbr', 'word', 'menu', 'kind', 'src', 'dst', 'len', 'max',
+             'min', 'count', 'offset', 'range', 'scope', 'event', 'timer',
+             'handler', 'request', 'response', 'error', 'config', 'option',
+             'factory', 'bean', 'post', 'processor', 'registry', 'abstract',
+             'manager', 'service', 'provider', 'context', 'session', 'a',
+             'b', 'x', 'y', 'i', 'n', 'http', 'json', 'xml', 'url', 'id']
+
+MATCHERS = [
+    ('prefix', {'name': 'prefix'}),
+    ('substr', {'name': 'substr'}),
+    ('abbrfuzzy', {'name': 'abbrfuzzy'}),
+    ('substrfuzzy', {'name': 'substrfuzzy'}),
+    ('fzy', {'name': 'fzy'}),
+    ('combine', {'name': 'combine',
+                 'matchers': ['prefix', 'substrfuzzy']}),
+]
+
+# sorters, and the matchers making their input
+SORTERS = [('abbrfuzzy', 'abbrfuzzy'), ('alphanum', 'abbrfuzzy'),
+           ('fzy', 'fzy')]
+
+
+def ident(rnd, nparts, style):
+    parts = [rnd.choice(SYLLABLES) for _ in range(nparts)]
+    if style == 'snake':
+        return '_'.join(parts)
+    if style == 'camel':
+        return parts[0] + ''.join(p.capitalize() for p in parts[1:])
+    if style == 'pascal':
+        return ''.join(p.capitalize() for p in parts)
+    if style == 'upper':
+        return '_'.join(parts).upper()
+    return ''.join(parts)
+
+
+def corpus_identifiers(rnd, n):
+    styles = ['snake', 'camel', 'pascal', 'upper', 'plain']
+    return [ident(rnd, rnd.randint(1, 4), rnd.choice(styles))
+            for _ in range(n)]
+
+
+def corpus_dictionary(rnd, n, words_file=None):
+    if words_file:
+        with open(words_file, encoding='utf-8', errors='ignore') as f:
+            words = [w.strip() for w in f if w.strip()]
+        return words[:n]
+    letters = 'etaoinshrdlcumwfgypbvkjxqz'
+    weights = list(range(len(letters), 0, -1))
+    return [''.join(rnd.choices(letters, weights, k=rnd.randint(3, 12)))
+            for _ in range(n)]
+
+
+def corpus_long_names(rnd, n):
+    # long names with repeated letters make the fuzzy matchers backtrack
+    styles = ['snake', 'camel', 'pascal']
+    return [ident(rnd, rnd.randint(8, 16), rnd.choice(styles))
+            for _ in range(n)]
+
+
+def corpora(args):
+    rnd = random.Random(args.seed)
+    scale = 10 if args.quick else 1
+    res = {}
+    words = corpus_identifiers(rnd, 20000 // scale)
+    res['identifiers'] = (words, queries(rnd, words, 10 // scale + 2))
+    words = corpus_dictionary(rnd, 100000 // scale, args.words)
+    res['dictionary'] = (words, queries(rnd, words, 5 // scale + 2))
+    words = corpus_long_names(rnd, 5000 // scale)
+    qs = queries(rnd, words, 5 // scale + 2)
+    # abbreviations, and a pattern that fails at the last character
+    qs += [abbrev(w) for w in rnd.sample(words, 3)]
+    qs += ['getgetgetsetx', 'abstractfactoryq']
+    res['long_names'] = (words, qs)
+    return res
+
+
+def abbrev(w):
+    res = [w[0]]
+    for i in range(1, len(w)):
+        if w[i - 1] == '_' or (w[i].isupper() and not w[i - 1].isupper()):
+            res.append(w[i])
+    return ''.join(res).replace('_', '')
+
+
+def queries(rnd, words, n):
+    res = []
+    for w in rnd.sample(words, n):
+        res.append(w[:rnd.randint(3, min(len(w), 12))])
+    return res
+
+
+def formalize(words):
+    return [dict(word=w, abbr=w, menu='', info='', kind='', icase=1,
+                 user_data=dict(source='bench', ncm2=1))
+            for w in words]
+
+
+def percentile(samples, p):
+    if not samples:
+        return 0.0
+    s = sorted(samples)
+    return s[min(len(s) - 1, int(round(p / 100.0 * (len(s) - 1))))]
+
+
+def keystrokes(qs):
+    for q in qs:
+        for i in range(1, len(q) + 1):
+            yield q[:i]
+
+
+def prefiltered(matcher, matches, args):
+    """
+    match_many behind the MatchIndex prefilter, as the core does.
+    """
+    match_many = matcher_many(matcher)
+    key = getattr(matcher, 'prefilter_key', None)
+    if args.no_index or not key:
+        return match_many
+    index = MatchIndex(key, matches)
+
+    def many(b, matches, infos=None):
+        sel = index.select(b, matches)
+        if sel is None:
+            return match_many(b, matches, infos)
+        indices, results = match_many(b, [matches[i] for i in sel], infos)
+        return [sel[i] for i in indices], results
+    return many
+
+
+def run_matcher(opt, words, qs, args):
+    matcher = matcher_get(dict(opt))
+    matches = formalize(words)
+    match_many = prefiltered(matcher, matches, args)
+
+    # the core keeps the MatchInfos with the cached matches of a source
+    infos = MatchInfos()
+    lat = []
+    matched = 0
+    for _ in range(args.repeat):
+        for b in keystrokes(qs):
+            t = time.perf_counter()
+            indices, _ = match_many(b, matches, infos)
+            lat.append(time.perf_counter() - t)
+            matched += len(indices)
+
+    allocs = []
+    tracemalloc.start()
+    try:
+        infos = MatchInfos()
+        for b in keystrokes(qs):
+            tracemalloc.reset_peak()
+            base, _ = tracemalloc.get_traced_memory()
+            match_many(b, matches, infos)
+            _, peak = tracemalloc.get_traced_memory()
+            allocs.append(peak - base)
+    finally:
+        tracemalloc.stop()
+
+    return stats(lat, len(matches), matched, allocs)
+
+
+def run_sorter(name, mname, words, qs, limit, args):
+    sorter = import_module('ncm2_sorter.' + name).Sorter(name=name)
+    match_many = matcher_many(matcher_get({'name': mname}))
+    matches = formalize(words)
+    infos = MatchInfos()
+
+    # sort the matched items of each keystroke
+    inputs = []
+    for b in keystrokes(qs):
+        indices, results = match_many(b, matches, infos)
+        items = []
+        for i, res in zip(indices, results):
+            m = dict(matches[i])
+            m['user_data'] = dict(m['user_data'], **res)
+            items.append(m)
+        inputs.append(items)
+
+    lat = []
+    total = 0
+    for _ in range(args.repeat):
+        for items in inputs:
+            items = list(items)
+            t = time.perf_counter()
+            if limit >= 0:
+                sorter(items, limit=limit)
+            else:
+                sorter(items)
+            lat.append(time.perf_counter() - t)
+            total += len(items)
+
+    allocs = []
+    tracemalloc.start()
+    try:
+        for items in inputs:
+            items = list(items)
+            tracemalloc.reset_peak()
+            base, _ = tracemalloc.get_traced_memory()
+            if limit >= 0:
+                sorter(items, limit=limit)
+            else:
+                sorter(items)
+            _, peak = tracemalloc.get_traced_memory()
+            allocs.append(peak - base)
+    finally:
+        tracemalloc.stop()
+
+    return stats(lat, total / max(len(lat), 1), total, allocs)
+
+
+def stats(lat, candidates, matched, allocs):
+    elapsed = sum(lat)
+    return {
+        'keystrokes': len(lat),
+        'candidates': candidates,
+        'matched': matched,
+        'throughput': candidates * len(lat) / elapsed if elapsed else 0.0,
+        'p50_ms': percentile(lat, 50) * 1000,
+        'p99_ms': percentile(lat, 99) * 1000,
+        'max_ms': max(lat) * 1000 if lat else 0.0,
+        'alloc_p50_kb': percentile(allocs, 50) / 1024.0,
+        'alloc_max_kb': max(allocs) / 1024.0 if allocs else 0.0,
+    }
+
+
+def run(args):
+    results = {}
+    for cname, (words, qs) in corpora(args).items():
+        for mname, opt in MATCHERS:
+            key = 'matcher/%s/%s' % (mname, cname)
+            if args.filter and args.filter not in key:
+                continue
+            results[key] = run_matcher(opt, words, qs, args)
+            report(key, results[key])
+        for sname, mname in SORTERS:
+            for limit in (-1, 50):
+                key = 'sorter/%s%s/%s' % (
+                    sname, '' if limit < 0 else '-top%d' % limit, cname)
+                if args.filter and args.filter not in key:
+                    continue
+                results[key] = run_sorter(sname, mname, words, qs, limit,
+                                          args)
+                report(key, results[key])
+    return results
+
+
+def report(key, r, base=None):
+    line = '%-40s %8d/s p50 %8.3fms p99 %8.3fms alloc %8.1fKB' % (
+        key, r['throughput'], r['p50_ms'], r['p99_ms'], r['alloc_p50_kb'])
+    if base:
+        line += '  p50 %+.0f%% p99 %+.0f%%' % (
+            change(base['p50_ms'], r['p50_ms']),
+            change(base['p99_ms'], r['p99_ms']))
+    print(line)
+    sys.stdout.flush()
+
+
+def change(old, new):
+    if not old:
+        return 0.0
+    return (new - old) / old * 100
+
+
+def compare(results, baseline, threshold):
+    print('\ncompared with the baseline:')
+    regressions = 0
+    for key, r in results.items():
+        base = baseline.get(key, None)
+        if not base:
+            continue
+        report(key, r, base)
+        if change(base['p50_ms'], r['p50_ms']) > threshold:
+            regressions += 1
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--quick', action='store_true',
+                        help='smaller corpora for a quick run')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='rounds of typing for the timing')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--words', help='a word list file for the '
+                        'dictionary corpus, one word per line')
+    parser.add_argument('--no-index', action='store_true',
+                        help="match without the core's MatchIndex prefilter")
+    parser.add_argument('--filter', help='only run the benchmarks whose '
+                        'name contains the string')
+    parser.add_argument('--save', help='save the results as json')
+    parser.add_argument('--compare', help='compare with the results saved '
+                        'by --save')
+    parser.add_argument('--threshold', type=float, default=10,
+                        help='p50 slow down in percent counted as a '
+                        'regression')
+    args = parser.parse_args()
+
+    results = run(args)
+
+    if args.save:
+        meta = dict(python=platform.python_version(),
+                    platform=platform.platform(),
+                    time=time.strftime('%Y-%m-%dT%H:%M:%S'),
+                    quick=args.quick, repeat=args.repeat, seed=args.seed)
+        with open(args.save, 'w') as f:
+            json.dump(dict(meta=meta, results=results), f, indent=2,
+                      sort_keys=True)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)['results']
+        if compare(results, baseline, args.threshold):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
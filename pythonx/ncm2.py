@@ -8,8 +8,12 @@ from subprocess import Popen
 from os import path
 import unicodedata
 from copy import deepcopy
+from bisect import bisect_right
+from itertools import accumulate
+from collections import OrderedDict
 import json
 import time
+import re
 
 __all__ = ['Ncm2Base', 'Ncm2Source', 'Popen']
 
@@ -57,6 +61,344 @@ def matcher_get(opt):
     m = mod.Matcher(**opt)
     return m
 
+def matcher_many(matcher):
+    """
+    Get the batch interface of the matcher:
+
+        match_many(base, matches, infos=None) -> (indices, results)
+
+    indices are the positions of the matched items in matches, results are
+    the user_data fields (match_key, match_highlight) for each of them.
+    infos is an optional MatchInfos of the source for reusing per candidate
+    data.  Matchers that only implement the per item match(base, m) are
+    adapted.
+    """
+    many = getattr(matcher, 'match_many', None)
+    if many:
+        return many
+
+    def match_many(b, matches, infos=None):
+        indices = []
+        results = []
+        for i, m in enumerate(matches):
+            if not matcher(b, m):
+                continue
+            ud = m['user_data']
+            indices.append(i)
+            results.append({k: ud[k] for k in ('match_key', 'match_highlight')
+                            if k in ud})
+        return indices, results
+
+    return match_many
+
+def match_many_by_info(match, key='abbr', case='smartcase', empty=None):
+    """
+    Get the match_many of a matcher that matches each character of the base
+    to a character of the candidate, from its per item
+
+        match(pat, s, info) -> user_data fields or None
+
+    pat is the match_pattern of the base, info the MatchInfo of the
+    candidate s. The candidates that can't match are skipped without calling
+    match. empty is the user_data fields of the matches of an empty base.
+    """
+    if empty is None:
+        empty = dict(match_key=key, match_highlight=[])
+
+    def match_many(b, matches, infos=None):
+        if len(b) == 0:
+            return list(range(len(matches))), [empty] * len(matches)
+
+        indices = []
+        results = []
+        pat = match_pattern(b, case)
+        n = len(pat)
+        # a candidate without upper case letter never matches a base with
+        # upper case letter, unless case is ignored
+        upper = case != 'icase' and any(raw and c.lower() != c
+                                        for c, raw in pat)
+        for i, m in enumerate(matches):
+            s = m[key]
+            if len(s) < n:
+                continue
+            info = infos[s] if infos is not None else MatchInfo(s)
+            if upper and not info.mask & MASK_UPPER:
+                continue
+            res = match(pat, s, info)
+            if res is None:
+                continue
+            indices.append(i)
+            results.append(res)
+        return indices, results
+
+    return match_many
+
+if hasattr(str, 'isascii'):
+    str_isascii = str.isascii
+else:
+    def str_isascii(s):
+        return all(ord(c) < 128 for c in s)
+
+def str_fold(s):
+    """
+    Lower case s character by character, so that positions in the result
+    are still positions in s. Characters whose lower case is longer than
+    one character are kept as is.
+    """
+    if str_isascii(s):
+        return s.lower()
+    res = []
+    for c in s:
+        lc = c.lower()
+        res.append(lc if len(lc) == 1 else c)
+    return ''.join(res)
+
+def get_abbrev(s):
+    res = []
+    if len(s) == 0:
+        return res
+    # always append 0 so that it should also detects prefix match
+    res.append(0)
+    for i in range(1, len(s)):
+        cp = s[i - 1]
+        c = s[i]
+        if not c.isalpha():
+            if c.isdecimal() and not cp.isdecimal():
+                res.append(i)
+            continue
+        elif not cp.isalpha():
+            res.append(i)
+            continue
+        elif c.isupper() and not cp.isupper():
+            res.append(i)
+            continue
+        else:
+            continue
+    return res
+
+MASK_UPPER = 1
+MASK_LOWER = 2
+MASK_DIGIT = 4
+MASK_OTHER = 8
+
+_digit_re = re.compile(r'\d')
+
+class MatchInfo:
+    """
+    Data of a candidate string for matchers: the word boundary offsets
+    (abbrev), the folded string (see str_fold) and a MASK_* character
+    class mask.
+    """
+    __slots__ = ('abbrev', 'folded', 'mask', '_positions')
+
+    def __init__(self, s):
+        folded = str_fold(s)
+        mask = 0
+        if s.lower() != s:
+            mask |= MASK_UPPER
+        if s.upper() != s:
+            mask |= MASK_LOWER
+        if _digit_re.search(s):
+            mask |= MASK_DIGIT
+        if s and not s.isalnum():
+            mask |= MASK_OTHER
+        self.abbrev = tuple(get_abbrev(s))
+        self.folded = folded
+        self.mask = mask
+        self._positions = None
+
+    def positions(self):
+        """
+        The sorted positions of each character of folded, built on the
+        first call.
+        """
+        res = self._positions
+        if res is None:
+            res = {}
+            for i, c in enumerate(self.folded):
+                if c in res:
+                    res[c].append(i)
+                else:
+                    res[c] = [i]
+            self._positions = res
+        return res
+
+class MatchInfos(dict):
+    """
+    MatchInfo of the candidates of a source, keyed by the matched string.
+    It's cached with the source's matches so the data is computed once per
+    source response instead of once per keystroke.
+    """
+
+    def __missing__(self, s):
+        info = MatchInfo(s)
+        self[s] = info
+        return info
+
+_char_bits = {chr(i): 1 << i for i in range(128)}
+
+def char_mask(s):
+    """
+    A bit for each ascii character in s, ignoring case. The lower case and
+    the case folded forms are included for other strings, so that a
+    candidate's mask covers the characters of any base it matches.
+    """
+    if str_isascii(s):
+        # distinct bits, sum is or
+        return sum(map(_char_bits.__getitem__, set(s.lower())))
+    chars = set(str_fold(s))
+    chars.update(s.lower(), s.casefold())
+    mask = 0
+    for c in chars:
+        mask |= _char_bits.get(c, 0)
+    return mask
+
+class MatchIndex:
+    """
+    Prefilter of the candidates of a source, for the matchers that set
+    prefilter_key on the match function: such a matcher only matches a
+    candidate containing every character of the base, ignoring case. The
+    character masks of the candidates are computed once, checking them
+    rejects most candidates before the matcher runs.
+    """
+
+    def __init__(self, key, matches):
+        self.key = key
+        self.masks = {}
+        self.add(matches)
+
+    def add(self, matches):
+        masks = self.masks
+        key = self.key
+        for m in matches:
+            s = m[key]
+            if s not in masks:
+                masks[s] = char_mask(s)
+
+    def select(self, b, matches):
+        """
+        Positions of the matches that may match b, None if all of them may.
+        """
+        need = char_mask(b)
+        if not need:
+            return None
+        key = self.key
+        masks = self.masks
+        res = []
+        for i, m in enumerate(matches):
+            mask = masks.get(m[key], None)
+            if mask is None or mask & need == need:
+                res.append(i)
+        return res
+
+# the character comparisons that fuzzy_match() of the matchers took before
+# the case option, they are still accepted as case
+def chcmp_smartcase(a, b): return a == b if a.isupper() else a == b.lower()
+
+def chcmp_case(a, b): return a == b
+
+def chcmp_icase(a, b): return a.lower() == b.lower()
+
+_chcmp_cases = {chcmp_smartcase: 'smartcase',
+                chcmp_case: 'case',
+                chcmp_icase: 'icase'}
+
+def match_pattern(b, case):
+    """
+    Convert the base into a list of (char, raw) for comparing with a
+    candidate. A raw char is compared with the candidate string, otherwise
+    with MatchInfo.folded.
+    """
+    if callable(case):
+        if case not in _chcmp_cases:
+            raise ValueError('unsupported character comparison %s' % case)
+        case = _chcmp_cases[case]
+    if case == 'smartcase':
+        return [(c, True) if c.isupper() else (c, False) for c in b]
+    elif case == 'icase':
+        return [(c, False) for c in str_fold(b)]
+    else:
+        return [(c, True) for c in b]
+
+def get_char_display_width(unicode_str):
+    r = unicodedata.east_asian_width(unicode_str)
+    if r == "F":  # Fullwidth
+        return 1
+    elif r == "H":  # Half-width
+        return 1
+    elif r == "W":  # Wide
+        return 2
+    elif r == "Na":  # Narrow
+        return 1
+    elif r == "A":  # Ambiguous, go with 2
+        return 1
+    elif r == "N":  # Neutral
+        return 1
+    else:
+        return 1
+
+_display_widths = {}
+_display_widths_max = 1024
+
+def strdisplaywidth(s):
+    """
+    Display width of s. An ascii string is as wide as its length, others
+    are memoized.
+    """
+    if str_isascii(s):
+        return len(s)
+    w = _display_widths.get(s, None)
+    if w is None:
+        w = 0
+        for c in unicodedata.normalize('NFC', s):
+            w += get_char_display_width(c)
+        if len(_display_widths) >= _display_widths_max:
+            _display_widths.clear()
+        _display_widths[s] = w
+    return w
+
+class LineIndex:
+    """
+    Start offsets of the lines of a text, for converting between a position
+    in the text and (lnum, ccol) without scanning the text.
+    """
+    __slots__ = ('text', 'starts')
+
+    def __init__(self, text):
+        self.text = text
+        starts = [0]
+        starts.extend(accumulate(len(l) + 1 for l in text.split('\n')))
+        starts.pop()
+        self.starts = starts
+
+    def lccol2pos(self, lnum, ccol):
+        return self.starts[lnum - 1] + ccol - 1
+
+    def pos2lccol(self, pos):
+        if not 0 <= pos <= len(self.text):
+            return None
+        idx = bisect_right(self.starts, pos) - 1
+        return (idx + 1, pos - self.starts[idx] + 1)
+
+_line_indexes = OrderedDict()
+_line_indexes_max = 8
+
+def line_index(src):
+    """
+    Get the LineIndex of src. The indexes of the recently used sources are
+    kept, so that converting positions in the same source repeatedly only
+    builds the index once.
+    """
+    idx = _line_indexes.get(src, None)
+    if idx is None:
+        idx = LineIndex(src)
+        _line_indexes[src] = idx
+        if len(_line_indexes) > _line_indexes_max:
+            _line_indexes.popitem(last=False)
+    else:
+        _line_indexes.move_to_end(src)
+    return idx
+
 def matcher_opt_formalize(opt):
     if type(opt) is str:
         return dict(name=opt)
@@ -85,22 +427,29 @@ class Ncm2Base:
     def matcher_get(self, opt):
         return matcher_get(opt)
 
-    def match_formalize(self, ctx, item):
+    def match_formalize(self, ctx, item, copy=True):
         e = {}
         if type(item) is str:
             e['word'] = item
-        else:
+        elif copy:
             e = deepcopy(item)
+        else:
+            e = item
 
         e['icase'] = 1
+        # menu and kind are usually shared by many items of a source
         if 'menu' not in e or type(e['menu']) != str:
             e['menu'] = ''
+        else:
+            e['menu'] = sys.intern(e['menu'])
         if 'info' not in e or type(e['info']) != str:
             e['info'] = ''
         if 'abbr' not in e or type(e['abbr']) != str:
             e['abbr'] = e['word']
         if 'kind' not in e or type(e['kind']) != str:
             e['kind'] = ''
+        else:
+            e['kind'] = sys.intern(e['kind'])
 
         # LanguageClient-neovim sends json-encoded user_data
         if type(e.get('user_data', None)) is str:
@@ -117,35 +466,23 @@ class Ncm2Base:
         ud['ncm2'] = 1
         return e
 
-    def matches_formalize(self, ctx, matches):
+    def matches_formalize(self, ctx, matches, copy=True):
         formalized = []
         for e in matches:
-            formalized.append(self.match_formalize(ctx, e))
+            formalized.append(self.match_formalize(ctx, e, copy))
         return formalized
 
     def lccol2pos(self, lnum, ccol, src):
         """
         convert lnum, ccol into pos
         """
-        lines = src.splitlines() or [""]
-
-        pos = 0
-        for i in range(lnum - 1):
-            pos += len(lines[i]) + 1
-        pos += ccol - 1
-
-        return pos
+        return line_index(src).lccol2pos(lnum, ccol)
 
     def pos2lccol(self, pos, src):
         """
         convert pos into lnum, ccol
         """
-        lines = src.splitlines() or [""]
-        p = 0
-        for idx, line in enumerate(lines):
-            if p <= pos and p + len(line) >= pos:
-                return (idx + 1, pos - p + 1)
-            p += len(line) + 1
+        return line_index(src).pos2lccol(pos)
 
     def get_src(self, src, ctx):
         """
@@ -169,28 +506,7 @@ class Ncm2Base:
                 sys.path.append(py3)
 
     def strdisplaywidth(self, s):
-        def get_char_display_width(unicode_str):
-            r = unicodedata.east_asian_width(unicode_str)
-            if r == "F":  # Fullwidth
-                return 1
-            elif r == "H":  # Half-width
-                return 1
-            elif r == "W":  # Wide
-                return 2
-            elif r == "Na":  # Narrow
-                return 1
-            elif r == "A":  # Ambiguous, go with 2
-                return 1
-            elif r == "N":  # Neutral
-                return 1
-            else:
-                return 1
-
-        s = unicodedata.normalize('NFC', s)
-        w = 0
-        for c in s:
-            w += get_char_display_width(c)
-        return w
+        return strdisplaywidth(s)
 
 
 class Ncm2Source(Ncm2Base):
@@ -207,6 +523,6 @@ class Ncm2Source(Ncm2Base):
         self.on_complete = on_complete
         logger.debug('on_complete is wrapped')
 
-    def complete(self, ctx, startccol, matches, refresh=False):
+    def complete(self, ctx, startccol, matches, refresh=False, append=False):
         self.nvim.call('ncm2#complete', ctx, startccol,
-                       matches, refresh, async_=True)
+                       matches, refresh, append, async_=True)
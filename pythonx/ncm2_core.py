@@ -2,12 +2,21 @@
 
 import re
 import vim
-from ncm2 import Ncm2Base, getLogger
+from ncm2 import Ncm2Base, getLogger, matcher_many, MatchInfos, MatchIndex
+import ncm2_parallel
 import json
 import glob
+import inspect
+import os
 from os import path, environ
 from importlib import import_module
 from copy import deepcopy
+from collections import OrderedDict, namedtuple
+from itertools import islice
+from operator import itemgetter
+from functools import wraps
+import heapq
+import math
 import time
 
 # don't import this module by other processes
@@ -15,6 +24,278 @@ assert environ['NVIM_YARP_MODULE'] == 'ncm2_core'
 
 logger = getLogger(__name__)
 
+Pipeline = namedtuple('Pipeline',
+                      ['matcher', 'match_many', 'sorter', 'sort_limit',
+                       'sort_key', 'sorter_id', 'filter'])
+
+
+def context_derive(ctx, **overrides):
+    """
+    Derive a context for a source or a subscope. The fields of ctx are
+    shared instead of deep copied, only top level fields may be replaced on
+    the derived context. It is still a plain dict for msgpack.
+    """
+    derived = dict(ctx)
+    derived.update(overrides)
+    return derived
+
+
+class StageStats:
+    """
+    Timing of a stage of the core. The samples are counted in a histogram
+    with logarithmic buckets, each bucket is 20% wider than the previous
+    one.
+    """
+    __slots__ = ('count', 'total', 'max', 'buckets')
+
+    base = 1.2
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.buckets = {}
+
+    def add(self, seconds):
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+        # microseconds
+        idx = int(math.log(seconds * 1e6 + 1, self.base))
+        self.buckets[idx] = self.buckets.get(idx, 0) + 1
+
+    def percentile(self, p):
+        """
+        Upper bound of the bucket that the percentile falls into, in
+        seconds.
+        """
+        rank = self.count * p / 100.0
+        n = 0
+        for idx in sorted(self.buckets):
+            n += self.buckets[idx]
+            if n >= rank:
+                return min((self.base ** (idx + 1) - 1) / 1e6, self.max)
+        return self.max
+
+
+def timed(stage):
+    """
+    Record the time of the decorated method of Ncm2Core as stage, when the
+    stats are enabled.
+    """
+    def decorator(f):
+        @wraps(f)
+        def wrapper(self, *args, **kwargs):
+            if self._stats is None:
+                return f(self, *args, **kwargs)
+            start = time.perf_counter()
+            try:
+                return f(self, *args, **kwargs)
+            finally:
+                self.stats_add(stage, time.perf_counter() - start)
+        return wrapper
+    return decorator
+
+
+class SourceStats:
+    """
+    Moving averages of the round trip latency, from the notification to
+    ncm2#complete, and of the result size of a source. inflight is the
+    context of the notification that hasn't been answered.
+    """
+    __slots__ = ('latency', 'size', 'count', 'inflight')
+
+    alpha = 0.3
+
+    def __init__(self):
+        self.latency = 0.0
+        self.size = 0.0
+        self.count = 0
+        self.inflight = None
+
+    def add(self, latency, size):
+        if self.count == 0:
+            self.latency = latency
+            self.size = size
+        else:
+            a = self.alpha
+            self.latency += a * (latency - self.latency)
+            self.size += a * (size - self.size)
+        self.count += 1
+
+    def budget(self):
+        """
+        Seconds the source is waited for, None if it's unknown.
+        """
+        if not self.count:
+            return None
+        return 2 * self.latency
+
+
+class UserDataJson:
+    """
+    JSON encoding of the user_data fields of a cached match, as sent by the
+    source. It's encoded on the first popup of the match and shared by the
+    copies of the match, only the fields added later by the matcher and the
+    filters are encoded on each popup.
+    """
+    __slots__ = ('fields', 'json')
+
+    def __init__(self, ud):
+        self.fields = dict(ud)
+        self.json = None
+
+    def __deepcopy__(self, memo):
+        return self
+
+    def dumps(self, ud):
+        fields = self.fields
+        extra = {}
+        n = 0
+        for k, v in ud.items():
+            if k not in fields:
+                extra[k] = v
+                continue
+            f = fields[k]
+            if f is not v and (type(f) is not type(v) or f != v):
+                return json.dumps(ud)
+            n += 1
+        if n != len(fields):
+            return json.dumps(ud)
+
+        if self.json is None:
+            self.json = json.dumps(fields)
+        if not extra:
+            return self.json
+        if not fields:
+            return json.dumps(extra)
+        return self.json[:-1] + ', ' + json.dumps(extra)[1:]
+
+
+def buf_number(buf):
+    return getattr(buf, 'number', buf)
+
+
+class BufMirror:
+    """
+    The lines of a buffer kept by the core for subscope detection, so that
+    the whole buffer doesn't need to be sent on every keystroke.
+
+    head and tail are the number of lines at the start and at the end of the
+    buffer that are unchanged since the last mark().
+    """
+    __slots__ = ('lines', 'tick', 'attached', 'head', 'tail', '_text')
+
+    def __init__(self, lines, tick, attached=False):
+        self.lines = list(lines)
+        self.tick = tick
+        self.attached = attached
+        self.head = 0
+        self.tail = 0
+        self._text = None
+
+    def replace(self, first, last, lines, tick):
+        """
+        Replace lines[first:last] with lines, last < 0 means the end of the
+        buffer. Returns False if the range doesn't fit the mirror.
+        """
+        if last < 0:
+            last = len(self.lines)
+        if not 0 <= first <= last <= len(self.lines):
+            return False
+        self.lines[first:last] = lines
+        self.tick = tick
+        self.head = min(self.head, first)
+        self.tail = min(self.tail, len(self.lines) - first - len(lines))
+        self._text = None
+        return True
+
+    def update(self, lines, tick):
+        """
+        Replace the whole buffer, only the lines that differ are marked as
+        changed.
+        """
+        old = self.lines
+        n = min(len(old), len(lines))
+        head = 0
+        while head < n and old[head] == lines[head]:
+            head += 1
+        tail = 0
+        while tail < n - head and old[-1 - tail] == lines[-1 - tail]:
+            tail += 1
+        self.replace(head, len(old) - tail,
+                     lines[head: len(lines) - tail], tick)
+
+    def mark(self):
+        self.head = self.tail = len(self.lines)
+
+    def text(self):
+        if self._text is None:
+            self._text = '\n'.join(self.lines)
+        return self._text
+
+
+class SubscopeCache:
+    """
+    The subscopes detected at the cursor. subs is a list of (index of the
+    parent context, fields of the subscope context, last line of the
+    subscope).
+    """
+    __slots__ = ('scope', 'detectors', 'tick', 'count', 'lnum', 'ccol',
+                 'line', 'subs')
+
+    def __init__(self, scope, detectors, mirror, lnum, ccol, subs):
+        self.scope = scope
+        self.detectors = detectors
+        self.tick = mirror.tick
+        self.count = len(mirror.lines)
+        self.lnum = lnum
+        self.ccol = ccol
+        self.line = mirror.lines[lnum - 1]
+        self.subs = subs
+
+
+_word_re = re.compile(r'\w*')
+
+
+def word_span_check(s, start, end):
+    """
+    Whether s[start:end] is made of word characters, and the word around it
+    is followed by a space or the end of the line, or preceded by a space.
+    The start of the line doesn't count, since a boundary may be anchored
+    there, and neither does a word that is alone on its line, like a
+    heredoc terminator.
+    """
+    if not _word_re.fullmatch(s, start, end):
+        return False
+    start -= len(_word_re.match(s[::-1], len(s) - start).group())
+    end = _word_re.match(s, end).end()
+    if not s[:start].strip() and not s[end:].strip():
+        return False
+    return end == len(s) or s[end].isspace() or \
+        (start > 0 and s[start - 1].isspace())
+
+
+def line_word_edit(old, ocur, new, ncur):
+    """
+    Whether the line is changed from old to new, and the cursor moved from
+    ocur to ncur, by editing a single word only. Subscope boundaries are
+    assumed to be made of non-word characters, like ``` or <script>, so
+    such an edit doesn't move the cursor across a boundary.
+    """
+    n = min(len(old), len(new))
+    p = 0
+    while p < n and old[p] == new[p]:
+        p += 1
+    s = 0
+    while s < n - p and old[-1 - s] == new[-1 - s]:
+        s += 1
+    if p == len(old) and p == len(new):
+        return word_span_check(new, min(ocur, ncur), max(ocur, ncur))
+    return (word_span_check(old, min(p, ocur), max(len(old) - s, ocur)) and
+            word_span_check(new, min(p, ncur), max(len(new) - s, ncur)))
+
 
 class Ncm2Core(Ncm2Base):
 
@@ -29,6 +310,45 @@ class Ncm2Core(Ncm2Base):
         self._notified = {}
         self._subscope_detectors = {}
 
+        # { stage: StageStats }, None if the stats are disabled
+        self._stats = None
+
+        # { source_name: SourceStats }, a source is slow if it takes longer
+        # than _slow_latency seconds to answer
+        self._source_stats = {}
+        self._slow_latency = 0.1
+
+        # the last popup list sent to vim, for the delta updates
+        self._popup_seq = 0
+        self._popup_sent = None
+
+        # each matches_update_popup gets a new generation, the unfinished
+        # work of an older one is dropped. With g:ncm2#filter_budget, the
+        # cached matches are matched in chunks of _filter_chunk candidates
+        self._popup_gen = 0
+        self._filter_chunk = 2000
+
+        # worker processes for matching large candidate sets, and the
+        # matcher options that failed in the workers
+        self._pool = None
+        self._pool_failed = set()
+
+        # { bufnr: BufMirror }
+        self._buffers = {}
+        # { bufnr: SubscopeCache }
+        self._subscopes = {}
+
+        # compiled matcher/sorter/filter and formalized options, keyed by
+        # the json encoded raw options
+        self._pipelines = OrderedDict()
+        self._matcher_opts = OrderedDict()
+        self._pipelines_max = 64
+
+        # compiled word/complete patterns, and the start of the word before
+        # the cursor keyed by (typed, word_pattern)
+        self._regexes = {}
+        self._word_starts = {}
+
         self._loaded_plugins = {}
 
         pats = {}
@@ -111,6 +431,7 @@ class Ncm2Core(Ncm2Base):
                     new_scope = True
 
                 self._subscope_detectors[scope].append(sd)
+                self._subscopes = {}
 
             logger.info('subscope detector <%s> for %s', py, sd.scope)
 
@@ -132,9 +453,9 @@ class Ncm2Core(Ncm2Base):
         root_ctx = data['context']
         contexts = self.detect_subscopes(data)
         for ctx in contexts:
-            ctx = deepcopy(ctx)
-            ctx['source'] = sr
-            ctx['matcher'] = self.matcher_opt_get(data, sr)
+            ctx = context_derive(ctx,
+                                 source=sr,
+                                 matcher=self.matcher_opt_get(data, sr))
             if not self.source_check_scope(sr, ctx):
                 continue
             self.source_check_patterns(data, sr, ctx)
@@ -174,9 +495,9 @@ class Ncm2Core(Ncm2Base):
         # regenerate contexts for this source
         contexts = self.detect_subscopes(data)
         for ctx in contexts:
-            ctx = deepcopy(ctx)
-            ctx['source'] = sr
-            ctx['matcher'] = self.matcher_opt_get(data, sr)
+            ctx = context_derive(ctx,
+                                 source=sr,
+                                 matcher=self.matcher_opt_get(data, sr))
             if not self.source_check_scope(sr, ctx):
                 continue
             self.source_check_patterns(data, sr, ctx)
@@ -198,8 +519,14 @@ class Ncm2Core(Ncm2Base):
             if name in notified and notified[name] == ctx:
                 logger.debug('%s notification is dated', name)
                 del notified[name]
+            st = self._source_stats.get(name, None)
+            if st and st.inflight and \
+                    st.inflight['context_id'] == ctx['context_id']:
+                st.inflight = None
 
+    @timed('on_complete')
     def on_complete(self, data, manual, failed_notifies=[]):
+        self.stats_sync(data)
 
         root_ctx = data['context']
         root_ctx['manual'] = manual
@@ -215,10 +542,10 @@ class Ncm2Core(Ncm2Base):
         for tmp_ctx in contexts:
             for name, sr in data['sources'].items():
 
-                ctx = deepcopy(tmp_ctx)
-                ctx['early_cache'] = False
-                ctx['source'] = sr
-                ctx['matcher'] = self.matcher_opt_get(data, sr)
+                ctx = context_derive(tmp_ctx,
+                                     early_cache=False,
+                                     source=sr,
+                                     matcher=self.matcher_opt_get(data, sr))
 
                 if not self.check_source_notify(data, sr, ctx):
                     continue
@@ -230,6 +557,7 @@ class Ncm2Core(Ncm2Base):
             for noti in notifies:
                 ctx = noti['context']
                 ctx['time'] = cur_time
+                self.source_stats_get(noti['name']).inflight = ctx
             self.notify('ncm2#_notify_complete', root_ctx, notifies)
         else:
             logger.debug('notifies is empty %s', notifies)
@@ -246,9 +574,7 @@ class Ncm2Core(Ncm2Base):
             for name in names:
                 sr = data['sources'][name]
 
-                ctx = deepcopy(tmp_ctx)
-                ctx['early_cache'] = False
-                ctx['source'] = sr
+                ctx = context_derive(tmp_ctx, early_cache=False, source=sr)
 
                 if not sr['enable']:
                     continue
@@ -260,6 +586,7 @@ class Ncm2Core(Ncm2Base):
 
         self.notify('ncm2#_warmup_sources', data['context'], warmups)
 
+    @timed('check_source_notify')
     def check_source_notify(self, data, sr, ctx):
         name = sr['name']
 
@@ -321,23 +648,64 @@ class Ncm2Core(Ncm2Base):
                         '<%s> has been notified, cache %s', name, cache)
                     return False
 
+        if need_refresh and self.source_busy(name, ctx):
+            # keep the refresh flag, the source is notified again after it
+            # answers
+            logger.debug('<%s> is slow and busy, defer the refresh', name)
+            return False
+
         if need_refresh:
             # reduce further duplicate notification
             cache['refresh'] = 0
         return True
 
-    def complete(self, data, sctx, startccol, matches, refresh):
+    def source_stats_get(self, name):
+        st = self._source_stats.get(name, None)
+        if st is None:
+            st = SourceStats()
+            self._source_stats[name] = st
+        return st
+
+    def source_busy(self, name, ctx):
+        """
+        Whether the source is slow and it's still working on a notification
+        for the same word. A source that doesn't answer in twice its usual
+        latency is not waited for.
+        """
+        st = self._source_stats.get(name, None)
+        if not st or not st.inflight or st.latency < self._slow_latency:
+            return False
+        inflight = st.inflight
+        if time.time() - inflight['time'] > st.budget():
+            return False
+        return all(inflight.get(k, None) == ctx[k]
+                   for k in ('bufnr', 'lnum', 'startccol'))
+
+    @timed('complete')
+    def complete(self, data, sctx, startccol, matches, refresh, append=0,
+                 popup=1):
+        """
+        Cache the matches of a source. With append, the matches are added
+        to the cached ones of the same context, and the popup is updated
+        only if popup is set, vim limits the rate of the updates.
+        """
+        self.stats_sync(data)
         ctx = data['context']
         self.cache_cleanup_check(ctx)
 
         name = sctx['source']['name']
+        cache = self._matches.get(name, None)
+        # the first chunk may be sent with append too
+        append = append and cache and \
+            cache['context']['context_id'] == sctx['context_id']
+        if not append:
+            self.source_stats_update(name, sctx, matches)
 
         sr = data['sources'].get(name, None)
         if not sr:
             logger.error("%s] source does not exist", name)
             return
 
-        cache = self._matches.get(name, None)
         if cache and cache['context']['context_id'] > sctx['context_id']:
             logger.debug('%s cache is newer, %s', name, cache)
             return
@@ -358,30 +726,140 @@ class Ncm2Core(Ncm2Base):
         if sctx['lnum'] == 1:
             startccol += sctx.get('scope_ccol', 1) - 1
 
-        matches = self.matches_formalize(sctx, matches)
+        if append:
+            if cache['startccol'] != startccol:
+                logger.error('%s appended matches startccol %s != %s',
+                             name, startccol, cache['startccol'])
+                return
+            self.matches_append(data, sr, cache, matches, refresh)
+            if popup:
+                self.matches_update_popup(data)
+            return
 
-        # filter before cache
-        old_le = len(matches)
-        matches = self.matches_filter_by_matcher(
-            data, sr, sctx, startccol, matches)
-        logger.debug('%s matches is filtered %s -> %s',
-                     name, old_le, len(matches))
+        matches = self.cache_formalize(sctx, matches)
+
+        # per candidate data for matchers, computed by the first matching
+        # and reused on the following keystrokes
+        infos = MatchInfos()
+
+        # prefilter for rejecting the candidates without the characters of
+        # the typing
+        index = None
+        key = getattr(self.pipeline_get(data, sr, sctx).matcher,
+                      'prefilter_key', None)
+        if key:
+            start = time.perf_counter()
+            index = MatchIndex(key, matches)
+            self.stats_add('match_index', time.perf_counter() - start)
+
+        shared = self.shared_matches(data, sctx, matches)
+
+        # filter before cache. With a time budget, a large result is cached
+        # as is, the popup matches it in chunks anyway
+        if data.get('filter_budget', 0) <= 0 or \
+                len(matches) <= self._filter_chunk:
+            old_le = len(matches)
+            matches = self.matches_filter_by_matcher(
+                data, sr, sctx, startccol, matches, infos, index, shared)
+            logger.debug('%s matches is filtered %s -> %s',
+                         name, old_le, len(matches))
 
         if not cache:
             self._matches[name] = {}
             cache = self._matches[name]
+        else:
+            self.cache_shared_close(cache)
 
         cache['startccol'] = startccol
         cache['refresh'] = refresh
         cache['matches'] = matches
+        cache['infos'] = infos
+        cache['index'] = index
+        cache['shared'] = shared
+        cache['narrow'] = None
+        cache['pending'] = None
         cache['context'] = sctx
         cache['enable'] = not sctx.get('early_cache', False)
 
         self.matches_update_popup(data)
 
+    def cache_formalize(self, sctx, matches):
+        """
+        Formalize the matches of a source for the cache. The matches are
+        decoded from the source's message, so they are formalized in place.
+        The matches without user_data of their own share the encoding of
+        the user_data.
+        """
+        start = time.perf_counter()
+        matches = self.matches_formalize(sctx, matches, copy=False)
+        self.stats_add('matches_formalize', time.perf_counter() - start)
+        plain = None
+        for m in matches:
+            ud = m['user_data']
+            # only the source and ncm2 fields set by match_formalize
+            if len(ud) == 2:
+                if plain is None:
+                    plain = UserDataJson(ud)
+                m['ncm2_user_data'] = plain
+            else:
+                m['ncm2_user_data'] = UserDataJson(ud)
+        return matches
+
+    def matches_append(self, data, sr, cache, matches, refresh):
+        """
+        Add the matches appended by a source to its cache. Only the new
+        matches are matched, the narrowed and the pending matches of the
+        current typing are extended.
+        """
+        sctx = cache['context']
+
+        matches = self.cache_formalize(sctx, matches)
+
+        index = cache['index']
+        if index:
+            start = time.perf_counter()
+            index.add(matches)
+            self.stats_add('match_index', time.perf_counter() - start)
+
+        # not in the shared block, they are matched serially, here and after
+        # the shared ones on the next keystrokes
+        matches = self.matches_filter_by_matcher(
+            data, sr, sctx, cache['startccol'], matches, cache['infos'], index)
+        logger.debug('%s appended %s matches', sr['name'], len(matches))
+
+        # the lists are not extended in place, the shared block finds its
+        # positions by the identity of the list
+        old = cache['matches']
+        cache['matches'] = old + matches
+        cache['refresh'] = refresh
+
+        typed = data['context']['typed']
+        matcher = self.pipeline_get(data, sr, sctx).matcher
+        narrow = cache['narrow']
+        if narrow and narrow['matcher'] is matcher and \
+                narrow['typed'] == typed:
+            narrow['matches'] = narrow['matches'] + matches
+        else:
+            cache['narrow'] = None
+
+        pending = cache['pending']
+        if pending and pending['base'] is old:
+            pending['base'] = cache['matches']
+        else:
+            cache['pending'] = None
+
+    def source_stats_update(self, name, sctx, matches):
+        if 'time' not in sctx:
+            return
+        st = self.source_stats_get(name)
+        st.add(time.time() - sctx['time'], len(matches))
+        inflight = st.inflight
+        if inflight and inflight['context_id'] <= sctx['context_id']:
+            st.inflight = None
+
     def is_kw_type(self, data, sr, ctx1, ctx2):
-        ctx1 = deepcopy(ctx1)
-        ctx2 = deepcopy(ctx2)
+        ctx1 = context_derive(ctx1)
+        ctx2 = context_derive(ctx2)
 
         self.source_check_patterns(data, sr, ctx1)
         self.source_check_patterns(data, sr, ctx2)
@@ -394,21 +872,103 @@ class Ncm2Core(Ncm2Base):
 
     # InsertEnter, InsertLeave, or lnum changed
     def cache_cleanup(self, *args):
+        for cache in self._matches.values():
+            self.cache_shared_close(cache)
         self._matches = {}
         self._notified = {}
         self._last_popup = []
+        for st in self._source_stats.values():
+            st.inflight = None
+
+    def cache_shared_close(self, cache):
+        shared = cache.get('shared', None)
+        if shared:
+            shared.close()
+            cache['shared'] = None
+
+    def complete_popup(self, data):
+        """
+        The popup update skipped for the appended matches.
+        """
+        self.matches_update_popup(data)
 
     def cache_cleanup_check(self, ctx):
         if self._cache_lnum != ctx['lnum']:
             self.cache_cleanup()
             self._cache_lnum = ctx['lnum']
 
+    @timed('detect_subscopes')
     def detect_subscopes(self, data):
         root_ctx = data['context']
         root_ctx['scope_level'] = 1
-        ctx_list = [root_ctx]
         sync_detectors = data['subscope_detectors']
-        src = '\n'.join(data['lines'])
+        scope = root_ctx['scope']
+
+        if not sync_detectors.get(scope, False) or \
+                not self._subscope_detectors.get(scope, None):
+            return [root_ctx]
+
+        bufnr = root_ctx['bufnr']
+        mirror = self.buf_mirror(data)
+        cache = self._subscopes.get(bufnr, None)
+
+        ctx_list = None
+        if cache:
+            ctx_list = self.subscopes_reuse(cache, mirror, root_ctx,
+                                            sync_detectors)
+        if ctx_list is None:
+            ctx_list, subs = self.subscopes_detect(root_ctx, sync_detectors,
+                                                   mirror.text())
+            lnum = root_ctx['lnum']
+            self._subscopes[bufnr] = SubscopeCache(
+                scope, sync_detectors, mirror, lnum, root_ctx['ccol'], subs)
+        mirror.mark()
+        return ctx_list
+
+    def subscopes_reuse(self, cache, mirror, root_ctx, sync_detectors):
+        """
+        Derive the subscope contexts from the cache if the cursor stays on
+        the same line and only word characters on the line are edited since
+        the last detection, which can't move the cursor out of the
+        subscopes.  Returns None if the subscopes need to be detected.
+        """
+        lnum, ccol = root_ctx['lnum'], root_ctx['ccol']
+        if cache.scope != root_ctx['scope'] or cache.lnum != lnum or \
+                cache.detectors != sync_detectors:
+            return None
+
+        # the first and last line of a subscope is shared with the parent
+        for _, fields, end_lnum in cache.subs:
+            if lnum == fields['scope_lnum'] or lnum == end_lnum:
+                return None
+
+        lines = mirror.lines
+        if len(lines) != cache.count:
+            return None
+        if mirror.tick != cache.tick and \
+                (mirror.head < lnum - 1 or mirror.tail < len(lines) - lnum):
+            return None
+
+        line = lines[lnum - 1]
+        if not line_word_edit(cache.line, cache.ccol - 1, line, ccol - 1):
+            return None
+
+        delta = len(line) - len(cache.line)
+        ctx_list = [root_ctx]
+        for parent, fields, _ in cache.subs:
+            fields['scope_len'] += delta
+            fields['lnum'] = lnum - fields['scope_lnum'] + 1
+            fields['ccol'] = ccol
+            ctx_list.append(context_derive(ctx_list[parent], **fields))
+
+        cache.tick = mirror.tick
+        cache.ccol = ccol
+        cache.line = line
+        return ctx_list
+
+    def subscopes_detect(self, root_ctx, sync_detectors, src):
+        ctx_list = [root_ctx]
+        subs = []
 
         i = 0
         while i < len(ctx_list):
@@ -430,8 +990,7 @@ class Ncm2Core(Ncm2Base):
                     res = sd.detect(lnum, ccol, scope_src)
                     if not res:
                         continue
-                    sub = deepcopy(ctx)
-                    sub.update(res)
+                    sub = context_derive(ctx, **res)
 
                     # adjust offset to global based and add the new context
                     sub['scope_offset'] += ctx.get('scope_offset', 0)
@@ -442,13 +1001,86 @@ class Ncm2Core(Ncm2Base):
                         sub['typed'] = sub['typed'][sub['scope_ccol'] - 1:]
                         sub['scope_ccol'] += ctx.get('scope_ccol', 1) - 1
 
+                    # for reusing by subscopes_reuse
+                    fields = {k: sub[k] for k in res}
+                    fields['scope_level'] = sub['scope_level']
+                    end_lnum = sub['scope_lnum'] + \
+                        self.get_src(src, sub).count('\n')
+                    subs.append((i - 1, fields, end_lnum))
+
                     ctx_list.append(sub)
                     logger.info('new sub context: %s', sub)
                 except Exception as ex:
                     logger.exception(
                         "exception on scope processing: %s", ex)
 
-        return ctx_list
+        return ctx_list, subs
+
+    def buf_mirror(self, data):
+        """
+        BufMirror of the current buffer. Neovim keeps the mirror updated by
+        the nvim_buf_attach events, vim8 sends the changed lines in
+        lines_delta, otherwise the whole buffer is sent in lines.  The
+        buffer is fetched if the mirror is out of sync.
+        """
+        ctx = data['context']
+        bufnr, tick = ctx['bufnr'], ctx['changedtick']
+        mirror = self._buffers.get(bufnr, None)
+
+        delta = data.get('lines_delta', None)
+        if data['lines']:
+            if mirror:
+                mirror.update(data['lines'], tick)
+            else:
+                mirror = BufMirror(data['lines'], tick)
+                self._buffers[bufnr] = mirror
+        elif delta:
+            if delta['base'] < 0:
+                mirror = BufMirror(delta['lines'], delta['tick'])
+                self._buffers[bufnr] = mirror
+            elif mirror and mirror.tick == delta['base']:
+                last = len(mirror.lines) - delta['suffix']
+                if not mirror.replace(delta['first'], last,
+                                      delta['lines'], delta['tick']):
+                    mirror.tick = None
+        elif data.get('lines_sync', '') == 'attach' and not mirror:
+            logger.debug('attach buffer %s', bufnr)
+            mirror = BufMirror([], None, True)
+            self._buffers[bufnr] = mirror
+            self.nvim.request('nvim_buf_attach', bufnr, True, {},
+                              async_=True)
+
+        if mirror and mirror.tick == tick:
+            return mirror
+
+        logger.info('buffer %s is out of sync, fetching the lines', bufnr)
+        lines = self.nvim.call('getbufline', bufnr, 1, '$')
+        if mirror:
+            mirror.update(lines, tick)
+        else:
+            mirror = BufMirror(lines, tick)
+            self._buffers[bufnr] = mirror
+        return mirror
+
+    def on_buf_lines(self, buf, tick, first, last, lines, more):
+        mirror = self._buffers.get(buf_number(buf), None)
+        if not mirror:
+            return
+        if not mirror.replace(first, last, lines, tick):
+            mirror.tick = None
+
+    def on_buf_changedtick(self, buf, tick):
+        mirror = self._buffers.get(buf_number(buf), None)
+        if mirror:
+            mirror.tick = tick
+
+    def on_buf_detach(self, buf):
+        self._buffers.pop(buf_number(buf), None)
+        self._subscopes.pop(buf_number(buf), None)
+
+    def lines_unload(self, _, bufnr):
+        self._buffers.pop(bufnr, None)
+        self._subscopes.pop(bufnr, None)
 
     def source_check_patterns(self, data, sr, ctx):
         pats = sr.get('complete_pattern', [])
@@ -460,29 +1092,16 @@ class Ncm2Core(Ncm2Base):
 
         # remove the last word, check whether the special pattern matches
         # word_removed
-        end_word_matched = re.search(word_pat + "$", typed)
-        if end_word_matched:
-            ctx['base'] = end_word_matched.group()
-            ctx['startccol'] = ctx['ccol'] - len(ctx['base'])
-            word_removed = typed[:end_word_matched.start()]
-            word_len = len(ctx['base'])
-        else:
-            ctx['base'] = ''
-            ctx['startccol'] = ctx['ccol']
-            word_removed = typed
-            word_len = 0
-
-        ctx['match_end'] = len(word_removed)
+        word_start = self.typed_word_start(typed, word_pat)
+        word_len = len(typed) - word_start
+        ctx['base'] = typed[word_start:]
+        ctx['startccol'] = ctx['ccol'] - word_len
+        ctx['match_end'] = word_start
         ctx['word_pattern'] = word_pat
 
         # check source extra patterns
         for pat in pats:
-            # use greedy match '.*', to push the match to the last occurance
-            # pattern
-            if not pat.startswith("^"):
-                pat = '.*' + pat
-
-            matched = re.search(pat, typed)
+            matched = self.complete_pattern_search(pat, typed)
             if matched and matched.end() >= len(typed) - word_len:
                 ctx['match_end'] = matched.end()
                 return True
@@ -496,6 +1115,49 @@ class Ncm2Core(Ncm2Base):
 
         return word_len >= cmplen
 
+    def regex_get(self, pat):
+        rx = self._regexes.get(pat, None)
+        if rx is None:
+            rx = re.compile(pat)
+            self._regexes[pat] = rx
+        return rx
+
+    def typed_word_start(self, typed, word_pat):
+        """
+        Get the start of the word before the cursor, the leftmost start of
+        the end anchored word pattern. The result is shared by all sources
+        with the same word pattern.
+        """
+        key = (typed, word_pat)
+        start = self._word_starts.get(key, None)
+        if start is not None:
+            return start
+
+        tokenizer = self.regex_get('(?:%s)$' % word_pat)
+        start = len(typed)
+        matched = tokenizer.search(typed)
+        if matched:
+            start = matched.start()
+
+        if len(self._word_starts) > 256:
+            self._word_starts = {}
+        self._word_starts[key] = start
+        return start
+
+    def complete_pattern_search(self, pat, typed):
+        if pat.startswith("^"):
+            return self.regex_get(pat).search(typed)
+
+        # find the match starting at the last possible position, which is
+        # what a greedy '.*' prefix finds, without backtracking over typed
+        # for every start position
+        rx = self.regex_get(pat)
+        for i in range(len(typed), -1, -1):
+            matched = rx.match(typed, i)
+            if matched:
+                return matched
+        return None
+
     def source_get_complete_len(self, data, sr):
         if 'complete_length' in sr:
             return sr['complete_length']
@@ -537,9 +1199,31 @@ class Ncm2Core(Ncm2Base):
                     return is_root
         return False
 
-    def matches_update_popup(self, data):
+    @timed('matches_update_popup')
+    def matches_update_popup(self, data, gen=None):
+        """
+        Filter the cached matches and pop them up. With
+        g:ncm2#filter_budget, the matches found within the budget are
+        popped up, and the rest are matched by a follow-up call with the
+        same gen after the pending messages are handled, unless a newer
+        call has started.
+        """
+        if gen is None:
+            self._popup_gen += 1
+            gen = self._popup_gen
+        elif gen != self._popup_gen:
+            logger.debug('popup %s is stale, current %s', gen,
+                         self._popup_gen)
+            return
+
         ctx = data['context']
 
+        budget = data.get('filter_budget', 0)
+        deadline = None
+        if budget > 0:
+            deadline = time.perf_counter() + budget / 1000
+        partial = False
+
         # sort by priority
         names = self._matches.keys()
         srcs = data['sources']
@@ -568,7 +1252,6 @@ class Ncm2Core(Ncm2Base):
                 logger.warn('%s invalid startccol %s', name, sccol)
                 continue
 
-            smat = deepcopy(cache['matches'])
             sctx = cache['context']
 
             if data['skip_tick']:
@@ -578,6 +1261,8 @@ class Ncm2Core(Ncm2Base):
                                  data['skip_tick'])
                     continue
 
+            smat, done = self.matches_narrow(data, sr, cache, deadline)
+            partial = partial or not done
             smat = self.matches_filter(data, sr, sctx, sccol, smat)
             cache['filtered_matches'] = smat
 
@@ -592,15 +1277,12 @@ class Ncm2Core(Ncm2Base):
         # additional filtering on inter-source level
         names = self.get_sources_for_popup(data, names_with_matches)
 
-        # merge results of sources, popup_limit
-        startccol = ccol
+        # popup_limit of each source
         for name in names:
             sr = srcs[name]
             cache = self._matches[name]
-            sccol = cache['startccol']
             filtered_matches = cache['filtered_matches']
 
-            # popup_limit
             popup_limit = sr.get('popup_limit', data['popup_limit'])
             if popup_limit >= 0:
                 filtered_matches = filtered_matches[: popup_limit]
@@ -611,57 +1293,185 @@ class Ncm2Core(Ncm2Base):
                                  len(filtered_matches))
                     cache['filtered_matches'] = filtered_matches
 
-            for m in filtered_matches:
-                ud = m['user_data']
-                mccol = ud.get('startccol', sccol)
-                if mccol < startccol:
-                    startccol = mccol
+        # merge results of sources, total_popup_limit
+        merged = self.matches_merge(data, names)
 
-        typed = ctx['typed']
-        matches = []
-        for name in names:
+        # don't keep the copies in the cache until the next popup
+        for cache in self._matches.values():
+            cache['filtered_matches'] = []
 
-            try:
-                sr = srcs[name]
-                cache = self._matches[name]
-                smat = cache['filtered_matches']
-                if not smat:
-                    continue
+        startccol = ccol
+        for sccol, m in merged:
+            ud = m['user_data']
+            mccol = ud.get('startccol', sccol)
+            if mccol < startccol:
+                startccol = mccol
 
-                sccol = cache['startccol']
-                for e in smat:
-                    ud = e['user_data']
-                    mccol = ud.get('startccol', sccol)
+        # only the items that make the popup are padded
+        matches = self.matches_pad(ctx['typed'], startccol, merged)
+
+        logger.info('popup names: %s, startccol: %s, matches cnt: %s',
+                    names, startccol, len(matches))
+
+        matches = self.matches_decorate(data, matches)
+
+        # vim only waits for the late sources with the adaptive delay, the
+        # wait is not part of the popup otherwise
+        wait = -1
+        if data.get('popup_delay_adaptive', 0):
+            wait = self.popup_wait()
+        self.matches_do_popup(ctx, startccol, matches,
+                              data.get('popup_delta', 0), wait)
+
+        if partial:
+            logger.debug('popup %s is partial, continue matching', gen)
+            self.nvim.async_call(
+                lambda: self.matches_update_popup(data, gen))
+
+    def popup_wait(self):
+        """
+        Milliseconds until the sources still working on the current line
+        are late, 0 if there's none, -1 if the latency of one of them is
+        unknown.
+        """
+        now = time.time()
+        wait = 0
+        for st in self._source_stats.values():
+            inflight = st.inflight
+            if not inflight:
+                continue
+            budget = st.budget()
+            if budget is None:
+                return -1
+            wait = max(wait, inflight['time'] + budget - now)
+        return int(math.ceil(wait * 1000))
+
+    def matches_pad(self, typed, startccol, merged):
+        """
+        Prefix the matches starting after startccol with the typed text
+        between, the padding is computed once for each distinct start
+        column.
+        """
+        pads = {}
+        matches = []
+        for sccol, e in merged:
+            try:
+                ud = e['user_data']
+                mccol = ud.get('startccol', sccol)
+                pad = pads.get(mccol, None)
+                if pad is None:
                     prefix = typed[startccol-1: mccol-1]
-                    dw = self.strdisplaywidth(prefix)
-                    space_pad = ' ' * dw
+                    pad = (prefix, ' ' * self.strdisplaywidth(prefix))
+                    pads[mccol] = pad
 
+                prefix, space_pad = pad
+                if prefix:
                     e['abbr'] = space_pad + e['abbr']
                     e['word'] = prefix + e['word']
-                matches += smat
+                matches.append(e)
 
             except Exception as inst:
                 logger.exception(
                     '_refresh_completions process exception: %s', inst)
                 continue
+        return matches
 
-        logger.info('popup names: %s, startccol: %s, matches cnt: %s',
-                    names, startccol, len(matches))
+    def matches_merge(self, data, names):
+        """
+        Merge the sorted matches of the sources, ordered by priority then by
+        the sort key. Sources with the same priority and the same sorter
+        are interleaved by the sort key, otherwise a source's matches
+        follow the previous source's.  Only the first total_popup_limit
+        items are taken from the sources. Returns a list of (startccol of
+        the source, match).
+        """
+        srcs = data['sources']
 
-        matches = self.matches_decorate(data, matches)
+        groups = {}
+        streams = []
+        for name in names:
+            sr = srcs[name]
+            cache = self._matches[name]
+            pipeline = self.pipeline_get(data, sr, cache['context'])
+            key = pipeline.sort_key
 
-        self.matches_do_popup(ctx, startccol, matches)
+            # sort keys are only comparable within the same sorter
+            if key is None:
+                group = (sr['priority'], name)
+            else:
+                group = (sr['priority'], pipeline.sorter_id)
+            group = groups.setdefault(group, len(groups))
+
+            streams.append(self.matches_stream(
+                group, key, cache['startccol'], cache['filtered_matches']))
+
+        merged = heapq.merge(*streams, key=itemgetter(0))
+
+        limit = data.get('total_popup_limit', -1)
+        if limit >= 0:
+            merged = islice(merged, limit)
+
+        return [(sccol, m) for _, sccol, m in merged]
+
+    def matches_stream(self, group, key, sccol, matches):
+        for m in matches:
+            yield (group, key(m) if key else 0), sccol, m
 
     def get_sources_for_popup(self, data, names):
         return names
 
+    def lru_get(self, lru, key, build):
+        val = lru.get(key, None)
+        if val is not None:
+            lru.move_to_end(key)
+            return val
+        val = build()
+        lru[key] = val
+        if len(lru) > self._pipelines_max:
+            lru.popitem(last=False)
+        return val
+
+    def pipeline_get(self, data, sr, sctx):
+        """
+        Get the compiled (matcher, sorter, filter) for the source. Each is
+        compiled once for a distinct set of options, so changes of
+        g:ncm2#matcher and friends, or source overrides, are picked up by a
+        new key.
+        """
+        key = json.dumps([sctx['matcher'],
+                          data['sorter'],
+                          sr.get('sorter', None),
+                          sr.get('filter', data['filter'])],
+                         sort_keys=True)
+
+        def build():
+            logger.debug('compile pipeline %s', key)
+            matcher = self.matcher_get(sctx['matcher'])
+            sorter_opt = self.sorter_opt_get(data, sr)
+            sorter = self.sorter_get(sorter_opt)
+            filt = self.filter_get(self.filter_opt_get(data, sr))
+            return Pipeline(matcher, matcher_many(matcher),
+                            sorter, self.sorter_limit_support(sorter),
+                            getattr(sorter, 'key', None),
+                            json.dumps(sorter_opt, sort_keys=True),
+                            filt)
+
+        return self.lru_get(self._pipelines, key, build)
+
     def matcher_opt_get(self, data, sr):
-        gmopt = self.matcher_opt_formalize(data['matcher'])
-        smopt = {}
-        if 'matcher' in sr:
-            smopt = self.matcher_opt_formalize(sr['matcher'])
-        gmopt.update(smopt)
-        return gmopt
+        # the result is shared between contexts, don't modify it
+        key = json.dumps([data['matcher'], sr.get('matcher', None)],
+                         sort_keys=True)
+
+        def build():
+            gmopt = self.matcher_opt_formalize(data['matcher'])
+            smopt = {}
+            if 'matcher' in sr:
+                smopt = self.matcher_opt_formalize(sr['matcher'])
+            gmopt.update(smopt)
+            return gmopt
+
+        return self.lru_get(self._matcher_opts, key, build)
 
     def sorter_opt_formalize(self, opt):
         if type(opt) is str:
@@ -672,10 +1482,20 @@ class Ncm2Core(Ncm2Base):
         gsopt = self.sorter_opt_formalize(data['sorter'])
         ssopt = {}
         if 'sorter' in sr:
-            ssopt = self.sorter_opt_formalize(opt)
+            ssopt = self.sorter_opt_formalize(sr['sorter'])
         gsopt.update(ssopt)
         return gsopt
 
+    def sorter_limit_support(self, sorter):
+        """
+        Whether the sorter accepts a limit argument, for returning only the
+        first limit items.
+        """
+        try:
+            return 'limit' in inspect.signature(sorter).parameters
+        except (TypeError, ValueError):
+            return False
+
     def sorter_get(self, opt):
         name = opt['name']
         modname = 'ncm2_sorter.' + name
@@ -711,34 +1531,268 @@ class Ncm2Core(Ncm2Base):
             for f in filts:
                 matches = f(data, sr, sctx, sccol, matches)
             return matches
+        # a filter that doesn't change the nested values of the items sets
+        # readonly, the items are deep copied for the others
+        handler.readonly = all(getattr(f, 'readonly', False) for f in filts)
         return handler
 
-    def matches_filter_by_matcher(self, data, sr, sctx, sccol, matches):
+    @timed('matches_filter_by_matcher')
+    def matches_filter_by_matcher(self, data, sr, sctx, sccol, matches,
+                                  infos=None, index=None, shared=None):
         ctx = data['context']
         typed = ctx['typed']
-        matcher = self.matcher_get(sctx['matcher'])
+        pipeline = self.pipeline_get(data, sr, sctx)
+        matcher = pipeline.matcher
+        match_many = pipeline.match_many
+
+        if shared is not None:
+            match_many = self.parallel(data, sctx, match_many, shared)
+
+        if index is not None and \
+                index.key == getattr(matcher, 'prefilter_key', None):
+            match_many = self.prefiltered(match_many, index)
+
+        # group by base, usually all the matches share the startccol of the
+        # source
+        groups = {}
+        for i, m in enumerate(matches):
+            mccol = m['user_data'].get('startccol', sccol)
+            groups.setdefault(mccol, []).append(i)
+
+        if len(groups) == 1:
+            mccol, = groups
+            indices, results = match_many(typed[mccol-1:], matches, infos)
+        else:
+            indices = []
+            results = []
+            for mccol, group in groups.items():
+                idx, res = match_many(typed[mccol-1:],
+                                      [matches[i] for i in group],
+                                      infos)
+                indices += [group[i] for i in idx]
+                results += res
+            # keep the order of the candidates
+            order = sorted(range(len(indices)), key=indices.__getitem__)
+            indices = [indices[i] for i in order]
+            results = [results[i] for i in order]
+
         tmp = []
-        for m in matches:
-            ud = m['user_data']
-            mccol = ud.get('startccol', sccol)
-            base = typed[mccol-1:]
-            if matcher(base, m):
-                tmp.append(m)
+        for i, res in zip(indices, results):
+            m = matches[i]
+            m['user_data'].update(res)
+            tmp.append(m)
         return tmp
 
-    def matches_filter(self, data, sr, sctx, sccol, matches):
-        matches = self.matches_filter_by_matcher(
-            data, sr, sctx, sccol, matches)
-
-        sorter = self.sorter_get(self.sorter_opt_get(data, sr))
-        matches = sorter(matches)
+    def shared_matches(self, data, sctx, matches):
+        """
+        Copy the candidates into a shared memory block for the worker pool,
+        if there are g:ncm2#parallel_threshold or more of them.
+        """
+        threshold = data.get('parallel_threshold', -1)
+        opt = sctx['matcher']
+        if threshold < 0 or len(matches) < max(threshold, 1) or \
+                not self.parallel_supported(opt):
+            return None
+        try:
+            return ncm2_parallel.SharedMatches(
+                ncm2_parallel.matcher_key(opt), matches)
+        except Exception:
+            logger.exception('failed sharing the matches')
+            return None
+
+    def parallel(self, data, sctx, match_many, shared):
+        """
+        Wrap match_many, so that g:ncm2#parallel_threshold or more of the
+        candidates in the shared block are matched by the worker pool, the
+        candidates appended after the block are matched serially.
+        The results are in the order of the candidates, as match_many's.
+        """
+        threshold = data.get('parallel_threshold', -1)
+        opt = sctx['matcher']
+        if threshold < 0 or shared.key != ncm2_parallel.matcher_key(opt) or \
+                not self.parallel_supported(opt):
+            return match_many
+
+        def parallel_many(b, matches, infos=None):
+            if len(matches) < max(threshold, 1):
+                return match_many(b, matches, infos)
+            positions = shared.positions(matches)
+            n = len(positions)
+            if n < max(threshold, 1):
+                return match_many(b, matches, infos)
+            try:
+                indices, results = self.pool_get(data).match_many(
+                    shared, opt, b, positions)
+            except Exception:
+                # the pool is still usable, but the matcher would fail
+                # again on the next keystroke
+                logger.exception('parallel matching failed')
+                self._pool_failed.add(json.dumps(opt, sort_keys=True))
+                return match_many(b, matches, infos)
+            if n < len(matches):
+                idx, res = match_many(b, matches[n:], infos)
+                indices = indices + [n + i for i in idx]
+                results = results + res
+            return indices, results
+        return parallel_many
+
+    def parallel_supported(self, opt):
+        if json.dumps(opt, sort_keys=True) in self._pool_failed:
+            return False
+        return ncm2_parallel.supported(opt)
+
+    def pool_get(self, data):
+        workers = data.get('parallel_workers', 0)
+        if workers <= 0:
+            workers = max((os.cpu_count() or 1) - 1, 1)
+        pool = self._pool
+        if pool and pool.workers != workers:
+            self.pool_close()
+            pool = None
+        if not pool:
+            logger.info('start %s matching workers', workers)
+            pool = ncm2_parallel.Pool(workers)
+            self._pool = pool
+        return pool
+
+    def pool_close(self):
+        if self._pool:
+            self._pool.close()
+            self._pool = None
+
+    def prefiltered(self, match_many, index):
+        """
+        Wrap match_many, so that the matcher only runs on the candidates
+        passing the MatchIndex.
+        """
+        def prefiltered_many(b, matches, infos=None):
+            start = time.perf_counter()
+            sel = index.select(b, matches)
+            self.stats_add('prefilter', time.perf_counter() - start)
+            if sel is None or len(sel) == len(matches):
+                return match_many(b, matches, infos)
+            indices, results = match_many(b, [matches[i] for i in sel],
+                                          infos)
+            return [sel[i] for i in indices], results
+        return prefiltered_many
+
+    def matches_narrow(self, data, sr, cache, deadline=None):
+        """
+        Match the cached matches against current typing. If the typing only
+        extends the typing of the last call and the matcher is monotonic,
+        the previously matched set is refined instead of the whole cache.
+
+        Returns (matches, done). With a deadline, the candidates are matched
+        in chunks until the deadline passes, the progress is kept in
+        cache['pending'] for the next call and done is False. Only a done
+        result is kept for narrowing.
+        """
+        sctx = cache['context']
+        sccol = cache['startccol']
+        typed = data['context']['typed']
+        matcher = self.pipeline_get(data, sr, sctx).matcher
+
+        narrow = cache.get('narrow', None)
+        if narrow and narrow['matcher'] is matcher and \
+                narrow['typed'] == typed:
+            return narrow['matches'], True
+
+        pending = cache.get('pending', None)
+        if not pending or pending['matcher'] is not matcher or \
+                pending['typed'] != typed:
+            if narrow and getattr(matcher, 'monotonic', False) and \
+                    typed.startswith(narrow['typed']):
+                base = narrow['matches']
+            else:
+                base = cache['matches']
+            pending = dict(typed=typed, matcher=matcher, base=base, pos=0,
+                           matches=[])
+
+        base = pending['base']
+        matches = pending['matches']
+        pos = pending['pos']
+        step = len(base)
+        if deadline is not None and not cache.get('shared', None):
+            step = self._filter_chunk
+        while pos < len(base):
+            chunk = base
+            if pos or step < len(base):
+                chunk = base[pos: pos + step]
+            matches += self.matches_filter_by_matcher(
+                data, sr, sctx, sccol, chunk, cache['infos'],
+                cache.get('index', None), cache.get('shared', None))
+            pos += len(chunk)
+            if deadline is not None and pos < len(base) and \
+                    time.perf_counter() > deadline:
+                logger.debug('%s matches is narrowed %s of %s, deadline',
+                             sr['name'], pos, len(base))
+                pending['pos'] = pos
+                cache['pending'] = pending
+                # the popup may sort it in place
+                return list(matches), False
+
+        logger.debug('%s matches is narrowed %s -> %s',
+                     sr['name'], len(base), len(matches))
+        cache['pending'] = None
+        cache['narrow'] = dict(typed=typed, matcher=matcher, matches=matches)
+        return matches, True
 
-        opt = self.filter_opt_get(data, sr)
-        filt = self.filter_get(opt)
-        matches = filt(data, sr, sctx, sccol, matches)
+    def matches_filter(self, data, sr, sctx, sccol, matches):
+        """
+        Sort and filter the matched items. The items are copied after
+        sorting since they are modified later for the popup, so only the
+        top items are copied when popup_limit or total_popup_limit is set.
+        """
+        pipeline = self.pipeline_get(data, sr, sctx)
+
+        # no more than total_popup_limit items of a source make the popup
+        limit = sr.get('popup_limit', data['popup_limit'])
+        total = data.get('total_popup_limit', -1)
+        if limit < 0 or 0 <= total < limit:
+            limit = total
+        if pipeline.sort_limit and 0 <= limit < len(matches):
+            start = time.perf_counter()
+            top = pipeline.sorter(matches, limit=limit)
+            self.stats_add('sort', time.perf_counter() - start)
+            start = time.perf_counter()
+            top = pipeline.filter(data, sr, sctx, sccol,
+                                  self.matches_copy(top, pipeline.filter))
+            self.stats_add('filter', time.perf_counter() - start)
+            if len(top) >= limit:
+                return top
+            # the filters dropped some of the top items, sort all of them
+            logger.debug('%s top %s items filtered to %s',
+                         sr['name'], limit, len(top))
+
+        # the list is shared with the narrowing cache, don't sort it in place
+        start = time.perf_counter()
+        matches = pipeline.sorter(list(matches))
+        self.stats_add('sort', time.perf_counter() - start)
+        start = time.perf_counter()
+        matches = pipeline.filter(data, sr, sctx, sccol,
+                                  self.matches_copy(matches, pipeline.filter))
+        self.stats_add('filter', time.perf_counter() - start)
 
         return matches
 
+    def matches_copy(self, matches, filt=None):
+        """
+        Copy the sorted items for the filters and the popup, which change
+        the fields of the items and of their user_data. The values are
+        shared with the cached items, only the two dicts are copied, unless
+        filt may change the nested values. The encoded user_data of the
+        cached items is only valid while their values are unchanged.
+        """
+        if filt is not None and not filt.readonly:
+            return deepcopy(matches)
+        res = []
+        for m in matches:
+            e = dict(m)
+            e['user_data'] = dict(m['user_data'])
+            res.append(e)
+        return res
+
+    @timed('matches_decorate')
     def matches_decorate(self, data, matches):
         return self.matches_add_source_mark(data, matches)
         return matches
@@ -753,12 +1807,19 @@ class Ncm2Core(Ncm2Base):
             e['menu'] = "[%s] %s" % (tag, e['menu'])
         return matches
 
-    def matches_do_popup(self, ctx, startccol, matches):
+    @timed('matches_do_popup')
+    def matches_do_popup(self, ctx, startccol, matches, delta=0, wait=-1):
         # json_encode user_data
         for m in matches:
-            m['user_data'] = json.dumps(m['user_data'])
+            udj = m.pop('ncm2_user_data', None)
+            if udj:
+                m['user_data'] = udj.dumps(m['user_data'])
+            else:
+                m['user_data'] = json.dumps(m['user_data'])
 
-        popup = [ctx['tick'], startccol, matches]
+        # the same list is sent again when all the sources have answered,
+        # so that vim doesn't wait for them
+        popup = (self.popup_fingerprint(ctx, startccol, matches), wait == 0)
         if self._last_popup == popup:
             return
         self._last_popup = popup
@@ -767,7 +1828,130 @@ class Ncm2Core(Ncm2Base):
         typed = ctx['typed']
         startbcol = len(typed[: startccol-1].encode()) + 1
 
-        self.notify('ncm2#_update_matches', ctx, startbcol, matches)
+        if not delta:
+            self._popup_sent = None
+            self.notify('ncm2#_update_matches', ctx, startbcol, matches,
+                        wait)
+            return
+
+        sent = self._popup_sent
+        self._popup_seq += 1
+        self._popup_sent = (self._popup_seq, ctx, startbcol, matches)
+        if sent:
+            ops = self.popup_delta(sent[3], matches)
+            self.notify('ncm2#_update_matches', ctx, startbcol, ops,
+                        wait, self._popup_seq, sent[0])
+        else:
+            self.notify('ncm2#_update_matches', ctx, startbcol, matches,
+                        wait, self._popup_seq, -1)
+
+    def popup_delta(self, old, matches):
+        """
+        Encode matches as changes to the old list: the index of an unchanged
+        item in old, [index, changed fields] of an item in old with the same
+        word, menu and kind, or the new item.
+        """
+        idx = {}
+        similar = {}
+        for i, m in enumerate(old):
+            idx.setdefault(self.popup_item_key(m), i)
+            similar.setdefault((m['word'], m['menu'], m['kind']), i)
+
+        ops = []
+        for m in matches:
+            i = idx.get(self.popup_item_key(m), None)
+            if i is not None:
+                ops.append(i)
+                continue
+            i = similar.get((m['word'], m['menu'], m['kind']), None)
+            if i is not None:
+                o = old[i]
+                if len(o.keys() - m.keys()) == 0:
+                    ops.append([i, {k: v for k, v in m.items()
+                                    if k not in o or o[k] != v}])
+                    continue
+            ops.append(m)
+        return ops
+
+    def popup_item_key(self, m):
+        """
+        A hashable key of a popup item, the JSON encoding for an item with
+        a list or dict field.
+        """
+        try:
+            k = tuple(m.items())
+            hash(k)
+            return k
+        except TypeError:
+            return json.dumps(m, sort_keys=True)
+
+    def popup_resync(self, data):
+        """
+        Vim doesn't have the list the last delta is based on, send the
+        whole list.
+        """
+        sent = self._popup_sent
+        if not sent:
+            return
+        seq, ctx, startbcol, matches = sent
+        logger.info('popup resync %s', seq)
+        self.notify('ncm2#_update_matches', ctx, startbcol, matches,
+                    self.popup_wait(), seq, -1)
+
+    def stats_sync(self, data):
+        """
+        Enable or disable the stats with g:ncm2#stats, and add the timing
+        of complete() from vim.
+        """
+        if not data.get('stats', 0):
+            self._stats = None
+            return
+        if self._stats is None:
+            self._stats = {}
+        for seconds in data.get('complete_times', []):
+            self.stats_add('vim_complete', seconds)
+
+    def stats_add(self, stage, seconds):
+        stats = self._stats
+        if stats is None:
+            return
+        st = stats.get(stage, None)
+        if st is None:
+            st = StageStats()
+            stats[stage] = st
+        st.add(seconds)
+
+    def stats_reset(self, data):
+        if self._stats is not None:
+            self._stats = {}
+
+    def stats_get(self, data):
+        self.stats_sync(data)
+        if self._stats is None:
+            return ['ncm2 stats are disabled, enable with :Ncm2Stats on']
+        lines = ['%-28s %8s %9s %9s %9s %10s' % (
+            'stage', 'count', 'p50(ms)', 'p95(ms)', 'max(ms)', 'total(ms)')]
+        for stage, st in sorted(self._stats.items()):
+            lines.append('%-28s %8d %9.3f %9.3f %9.3f %10.1f' % (
+                stage, st.count, st.percentile(50) * 1000,
+                st.percentile(95) * 1000, st.max * 1000, st.total * 1000))
+        lines.append('')
+        lines.append('%-28s %8s %11s %9s' % (
+            'source', 'count', 'latency(ms)', 'size'))
+        for name, st in sorted(self._source_stats.items()):
+            lines.append('%-28s %8d %11.1f %9.1f' % (
+                name, st.count, st.latency * 1000, st.size))
+        return lines
+
+    def popup_fingerprint(self, ctx, startccol, matches):
+        """
+        A hash of the popup for skipping a popup that is the same as the
+        last one, instead of keeping and comparing all of the matches.
+        """
+        h = hash((json.dumps(ctx['tick']), startccol, len(matches)))
+        for m in matches:
+            h = hash((h, self.popup_item_key(m)))
+        return h
 
 
 ncm2_core = Ncm2Core(vim)
@@ -784,5 +1968,15 @@ on_warmup = ncm2_core.on_warmup
 on_notify_dated = ncm2_core.on_notify_dated
 on_complete_done = ncm2_core.on_complete_done
 get_context = ncm2_core.get_context
+popup_resync = ncm2_core.popup_resync
+complete_popup = ncm2_core.complete_popup
+stats_get = ncm2_core.stats_get
+stats_reset = ncm2_core.stats_reset
+lines_unload = ncm2_core.lines_unload
+
+# nvim_buf_attach events
+nvim_buf_lines_event = ncm2_core.on_buf_lines
+nvim_buf_changedtick_event = ncm2_core.on_buf_changedtick
+nvim_buf_detach_event = ncm2_core.on_buf_detach
 
 __all__ = events
@@ -11,4 +11,5 @@ def Filter(**kargs):
                 continue
             res.append(m)
         return res
+    filt.readonly = True
     return filt
@@ -1,82 +1,64 @@
-import re
+from ncm2 import get_abbrev, match_pattern, match_many_by_info, MatchInfo
+# the case of fuzzy_match(b, s, chcmp) calls
+from ncm2 import chcmp_smartcase, chcmp_case, chcmp_icase  # noqa: F401
 
-chcmp_smartcase = lambda a,b: a==b if a.isupper() else a==b.lower()
-chcmp_case = lambda a,b: a==b
-chcmp_icase = lambda a,b: a.lower()==b.lower()
 
-def get_abbrev(s):
-    res = []
-    if len(s) == 0:
-        return res
-    # always append 0 so that it should also detects prefix match
-    res.append(0)
-    for i in range(1, len(s)):
-        cp = s[i - 1]
-        c = s[i]
-        if not c.isalpha():
-            if c.isdecimal() and not cp.isdecimal():
-                res.append(i)
-            continue
-        elif not cp.isalpha():
-            res.append(i)
-            continue
-        elif c.isupper() and not cp.isupper():
-            res.append(i)
-            continue
-        else:
-            continue
-    return res
-
-def fuzzy_match(b, s, chcmp):
+def fuzzy_match(b, s, case, info=None):
     if len(b) == 0:
         return []
-    abbr = get_abbrev(s)
-    return abbr_fuzzy_match(abbr, b, s, 0, chcmp)
+    if info is None:
+        info = MatchInfo(s)
+    pat = match_pattern(b, case)
+    return abbr_fuzzy_match(info.abbrev, 0, pat, 0, s, info.folded, 0)
 
-def abbr_fuzzy_match(abbr, b, s, off, chcmp):
-    for i, p in enumerate(abbr):
-        p = p - off
-        if p < 0:
+def abbr_fuzzy_match(abbr, ai, pat, bi, s, f, off):
+    """
+    Match pat[bi:] against s starting from the boundaries abbr[ai:] that are
+    not before off.
+    """
+    for i in range(ai, len(abbr)):
+        p = abbr[i]
+        if p < off:
             continue
-        mcp = max_common_prefix(b, s[p:], chcmp)
-        if len(mcp) == len(b):
-            return [[off + p, off + p + len(mcp)]]
+        mcpl = common_prefix_len(pat, bi, s, f, p)
+        if mcpl == len(pat) - bi:
+            return [[p, p + mcpl]]
         # # max(mcpl-3, 0) don't fallback too deep for performance
-        mcpl = len(mcp)
         for l in range(mcpl, 0, -1):
-            b2 = b[l:]
-            s2 = s[p + l:]
-            m = abbr_fuzzy_match(abbr[i+1:], b2, s2, off + p + l, chcmp)
+            m = abbr_fuzzy_match(abbr, i + 1, pat, bi + l, s, f, p + l)
             if m:
-                return [[off + p, off + p + l]] + m
+                return [[p, p + l]] + m
     return None
 
-def max_common_prefix(b, s, chcmp):
+def common_prefix_len(pat, bi, s, f, p):
     l = 0
-    for c1, c2 in zip(b, s):
-        if chcmp(c1, c2):
-            l += 1
-        else:
+    for c, raw in pat[bi: bi + len(s) - p]:
+        if (s if raw else f)[p + l] != c:
             break
-    return b[:l]
+        l += 1
+    return l
 
 def Matcher(case='smartcase', key='abbr', **kargs):
 
-    if case == 'smartcase':
-        chcmp = chcmp_smartcase
-    elif case == 'icase':
-        chcmp = chcmp_icase
-    else:
-        chcmp = chcmp_case
-
     def match(b, m):
-        hl = fuzzy_match(b, m[key], chcmp)
+        hl = fuzzy_match(b, m[key], case)
         if hl is None:
             return False
         m['user_data']['match_key'] = key
         m['user_data']['match_highlight'] = hl
         return True
 
+    def match_info(pat, s, info):
+        hl = abbr_fuzzy_match(info.abbrev, 0, pat, 0, s, info.folded, 0)
+        if hl is None:
+            return None
+        return dict(match_key=key, match_highlight=hl)
+
+    match.match_many = match_many_by_info(match_info, key, case)
+    # a match of the base implies a match of the base's prefix
+    match.monotonic = True
+    # the matched candidates have all the characters of the base
+    match.prefilter_key = key
     return match
 
 def test_abbrev(s):
@@ -91,8 +73,7 @@ def test():
     s = 'abbr_fuzzy_match'
     b = 'abbrfuzzy'
     test_abbrev(s)
-    print(fuzzy_match(b, s, chcmp_smartcase))
-    print(max_common_prefix(b, s, chcmp_smartcase))
+    print(fuzzy_match(b, s, 'smartcase'))
 
 if __name__  == '__main__':
     test()
@@ -1,4 +1,4 @@
-from ncm2 import matcher_get, matcher_opt_formalize
+from ncm2 import matcher_get, matcher_opt_formalize, matcher_many
 from copy import deepcopy
 
 def Matcher(**kargs):
@@ -15,10 +15,36 @@ def Matcher(**kargs):
         matcher = matcher_get(tmp)
         matchers.append(matcher)
 
+    batches = [matcher_many(matcher) for matcher in matchers]
+
     def match(b, m):
         for matcher in matchers:
             if matcher(b, m):
                 return True
         return False
 
+    def match_many(b, matches, infos=None):
+        indices = []
+        results = []
+        # the candidates not yet matched by previous matchers
+        rest = list(range(len(matches)))
+        for batch in batches:
+            if not rest:
+                break
+            idx, res = batch(b, [matches[i] for i in rest], infos)
+            matched = [rest[i] for i in idx]
+            indices += matched
+            results += res
+            matched = set(matched)
+            rest = [i for i in rest if i not in matched]
+
+        # keep the order of the candidates
+        order = sorted(range(len(indices)), key=indices.__getitem__)
+        return [indices[i] for i in order], [results[i] for i in order]
+
+    match.match_many = match_many
+    match.monotonic = all(getattr(m, 'monotonic', False) for m in matchers)
+    keys = set(getattr(m, 'prefilter_key', None) for m in matchers)
+    if len(keys) == 1 and None not in keys:
+        match.prefilter_key, = keys
     return match
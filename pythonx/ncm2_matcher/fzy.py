@@ -0,0 +1,232 @@
+from ncm2 import match_pattern, match_many_by_info, MatchInfo
+
+# the scoring of fzy, https://github.com/jhawthorn/fzy
+SCORE_GAP_LEADING = -0.005
+SCORE_GAP_TRAILING = -0.005
+SCORE_GAP_INNER = -0.01
+SCORE_MATCH_CONSECUTIVE = 1.0
+SCORE_MATCH_SLASH = 0.9
+SCORE_MATCH_WORD = 0.8
+SCORE_MATCH_CAPITAL = 0.7
+SCORE_MATCH_DOT = 0.6
+
+# longer candidates are aligned greedily instead of by the DP
+MATCH_MAX_LEN = 1024
+
+NEG_INF = float('-inf')
+SCORE_EPS = 1e-9
+
+
+def get_bonus(s):
+    """
+    The bonus of matching each character of s, for the characters after a
+    separator or starting a camel case word.
+    """
+    res = []
+    prev = '/'
+    for c in s:
+        if c.isalnum():
+            if prev == '/':
+                b = SCORE_MATCH_SLASH
+            elif prev in '-_ ':
+                b = SCORE_MATCH_WORD
+            elif prev == '.':
+                b = SCORE_MATCH_DOT
+            elif c.isupper() and prev.islower():
+                b = SCORE_MATCH_CAPITAL
+            else:
+                b = 0
+        else:
+            b = 0
+        res.append(b)
+        prev = c
+    return res
+
+
+def fuzzy_match(b, s, case, info=None):
+    if len(b) == 0:
+        return [], 0
+    if info is None:
+        info = MatchInfo(s)
+    pat = match_pattern(b, case)
+    return fzy_match(pat, s, info.folded)
+
+
+def fzy_match(pat, s, f):
+    """
+    Find the alignment of pat in s with the best fzy score. Returns
+    (highlight, score), or None if pat is not a subsequence of s.
+
+    Only the positions of s that match a character of pat, between the
+    leftmost and the rightmost alignment, are visited, the gaps between them
+    are scored arithmetically. The worst case is O(len(pat) * len(s)).
+    """
+    n = len(pat)
+    m = len(s)
+
+    # leftmost alignment
+    lo = []
+    j = 0
+    for c, raw in pat:
+        j = (s if raw else f).find(c, j)
+        if j < 0:
+            return None
+        lo.append(j)
+        j += 1
+
+    bonus = get_bonus(s)
+
+    if m > MATCH_MAX_LEN:
+        return spans(lo), path_score(lo, bonus, m)
+
+    # rightmost alignment
+    hi = [0] * n
+    j = m
+    for i in range(n - 1, -1, -1):
+        c, raw = pat[i]
+        j = (s if raw else f).rfind(c, 0, j)
+        hi[i] = j
+
+    # rows[i] is (positions, D, M) at the positions matching pat[i]. D is
+    # the best score of pat[:i+1] ending with a match at the position, M the
+    # best score of pat[:i+1] in s[:position+1]
+    rows = []
+    pjs = pds = pms = None
+    for i, (c, raw) in enumerate(pat):
+        t = s if raw else f
+        gap = SCORE_GAP_TRAILING if i == n - 1 else SCORE_GAP_INNER
+        js = []
+        ds = []
+        ms = []
+        k = -1
+        last_j = 0
+        last_m = NEG_INF
+        j = t.find(c, lo[i], hi[i] + 1)
+        while j >= 0:
+            if i == 0:
+                d = j * SCORE_GAP_LEADING + bonus[j]
+            else:
+                # the last match of the previous row before j
+                while k + 1 < len(pjs) and pjs[k + 1] < j:
+                    k += 1
+                if k < 0:
+                    d = NEG_INF
+                else:
+                    d = pms[k] + SCORE_GAP_INNER * (j - 1 - pjs[k]) + \
+                        bonus[j]
+                    if pjs[k] == j - 1:
+                        d = max(d, pds[k] + SCORE_MATCH_CONSECUTIVE)
+            js.append(j)
+            ds.append(d)
+            last_m = max(d, last_m + gap * (j - last_j))
+            last_j = j
+            ms.append(last_m)
+            j = t.find(c, j + 1, hi[i] + 1)
+        rows.append((js, ds, ms))
+        pjs, pds, pms = js, ds, ms
+
+    js, ds, ms = rows[-1]
+    score = ms[-1] + SCORE_GAP_TRAILING * (m - 1 - js[-1])
+
+    # backtrack
+    positions = [0] * n
+    match_required = False
+    bound = m - 1
+    for i in range(n - 1, -1, -1):
+        js, ds, ms = rows[i]
+        gap = SCORE_GAP_TRAILING if i == n - 1 else SCORE_GAP_INNER
+        x = len(js) - 1
+        while js[x] > bound:
+            x -= 1
+        # prefer the earlier match of the same score
+        while not match_required and x and \
+                ds[x] <= ms[x - 1] + gap * (js[x] - js[x - 1]) + SCORE_EPS:
+            x -= 1
+        j = js[x]
+        positions[i] = j
+        match_required = False
+        if i:
+            pjs, pds, _ = rows[i - 1]
+            if j - 1 in pjs:
+                pd = pds[pjs.index(j - 1)]
+                match_required = ds[x] == pd + SCORE_MATCH_CONSECUTIVE
+        bound = j - 1
+
+    return spans(positions), score
+
+
+def path_score(positions, bonus, m):
+    """
+    The score of matching at the positions.
+    """
+    score = positions[0] * SCORE_GAP_LEADING + bonus[positions[0]]
+    for p, q in zip(positions, positions[1:]):
+        if q == p + 1:
+            score += SCORE_MATCH_CONSECUTIVE
+        else:
+            score += SCORE_GAP_INNER * (q - p - 1) + bonus[q]
+    return score + SCORE_GAP_TRAILING * (m - 1 - positions[-1])
+
+
+def spans(positions):
+    res = []
+    for p in positions:
+        if res and res[-1][1] == p:
+            res[-1][1] = p + 1
+        else:
+            res.append([p, p + 1])
+    return res
+
+
+def Matcher(case='smartcase', key='abbr', **kargs):
+
+    def match(b, m):
+        res = fuzzy_match(b, m[key], case)
+        if res is None:
+            return False
+        hl, score = res
+        m['user_data']['match_key'] = key
+        m['user_data']['match_highlight'] = hl
+        m['user_data']['match_score'] = round(score, 4)
+        return True
+
+    def match_info(pat, s, info):
+        res = fzy_match(pat, s, info.folded)
+        if res is None:
+            return None
+        hl, score = res
+        return dict(match_key=key, match_highlight=hl,
+                    match_score=round(score, 4))
+
+    match.match_many = match_many_by_info(
+        match_info, key, case,
+        dict(match_key=key, match_highlight=[], match_score=0))
+    # a match of the base implies a match of the base's prefix
+    match.monotonic = True
+    # the matched candidates have all the characters of the base
+    match.prefilter_key = key
+    return match
+
+
+def test_fuzzy_match(b, s, case):
+    print('base : ' + b)
+    print('str  : ' + s)
+    res = fuzzy_match(b, s, case)
+    if res is None:
+        print('match: ' + '-' * len(s))
+        return
+    highlights, score = res
+    s2 = ' ' * len(s)
+    for hl in highlights:
+        s2 = s2[: hl[0]] + ('^' * (hl[1] - hl[0])) + s2[hl[1]:]
+    print('match: ' + s2 + ' %.3f' % score)
+
+
+if __name__ == '__main__':
+    test_fuzzy_match('amor', 'app/models/order', 'smartcase')
+    print('')
+    test_fuzzy_match('subfuzzy', 'substr_fuzzy_match', 'smartcase')
+    print('')
+    test_fuzzy_match('gfn', 'getFieldByName', 'smartcase')
+    print('')
+    test_fuzzy_match('abcfoo', 'a_b_c_abc_abfoo', 'smartcase')
@@ -3,4 +3,11 @@ def Matcher(**kargs):
     def match(b, m):
         m['user_data']['match_highlight'] = []
         return True
+
+    def match_many(b, matches, infos=None):
+        n = len(matches)
+        return list(range(n)), [dict(match_highlight=[])] * n
+
+    match.match_many = match_many
+    match.monotonic = True
     return match
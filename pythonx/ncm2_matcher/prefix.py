@@ -25,26 +25,61 @@ def Matcher(case='smartcase', key='abbr', **kargs):
         lb = len(b)
         w = m[key][ : lb]
 
-        if lb != len(w):
+        if not smart_case_eq(b, w):
             return False
 
-        for c1, c2 in zip(b, w):
-            if c1 == c2:
-                continue
-            if c1.lower() != c2.lower():
-                return False
-            if c1.islower():
-                continue
-            else:
-                return False
-
         m['user_data']['match_key'] = key
         m['user_data']['match_highlight'] = [[0, lb]]
         return True
 
+    def match_many_case(b, matches, infos=None):
+        indices = [i for i, m in enumerate(matches) if m[key].startswith(b)]
+        return indices, [result(b)] * len(indices)
+
+    def match_many_icase(b, matches, infos=None):
+        lb = len(b)
+        lowered = b.lower()
+        indices = [i for i, m in enumerate(matches)
+                   if m[key][: lb].lower() == lowered]
+        return indices, [result(b)] * len(indices)
+
+    def match_many_smart_case(b, matches, infos=None):
+        lb = len(b)
+        folded = b.casefold()
+        # casefold equality is necessary for a smartcase match, the exact
+        # check runs only on the candidates passing it
+        indices = [i for i, m in enumerate(matches)
+                   if m[key][: lb].casefold() == folded and
+                   smart_case_eq(b, m[key][: lb])]
+        return indices, [result(b)] * len(indices)
+
+    def result(b):
+        # shared by all the matched items, don't modify it
+        return dict(match_key=key, match_highlight=[[0, len(b)]])
+
     if case == 'smartcase':
-        return match_smart_case
+        match = match_smart_case
+        match.match_many = match_many_smart_case
     elif case == 'icase':
-        return match_icase
+        match = match_icase
+        match.match_many = match_many_icase
     else:
-        return match_case
+        match = match_case
+        match.match_many = match_many_case
+
+    # a match of the base implies a match of the base's prefix
+    match.monotonic = True
+    return match
+
+
+def smart_case_eq(b, w):
+    if len(b) != len(w):
+        return False
+    for c1, c2 in zip(b, w):
+        if c1 == c2:
+            continue
+        if c1.lower() != c2.lower():
+            return False
+        if not c1.islower():
+            return False
+    return True
@@ -1,41 +1,25 @@
 # -*- coding: utf-8 -*-
 
+from bisect import bisect_right
+from itertools import accumulate
+
 
 def Matcher(case='smartcase', key='abbr', **kargs):
 
     def match_smart_case(b, e):
         w = e[key]
 
-        lw = len(w)
-        lb = len(b)
-
-        if lb > lw:
+        i = smart_case_find(b, w)
+        if i == -1:
             return False
 
-        if not lb:
+        if not b:
             e['user_data']['match_highlight'] = []
             return True
 
-        for i in range(lw - lb + 1):
-            match = True
-            sw = w[i: i + lb]
-            for cb, cw in zip(b, sw):
-                if cb == cw:
-                    continue
-                if cb.lower() != cw.lower():
-                    match = False
-                    break
-                if cb.islower():
-                    continue
-                else:
-                    match = False
-                    break
-            if match:
-                e['user_data']['match_key'] = key
-                e['user_data']['match_highlight'] = [[i, i + lb]]
-                return True
-
-        return False
+        e['user_data']['match_key'] = key
+        e['user_data']['match_highlight'] = [[i, i + len(b)]]
+        return True
 
     def match_case(b, e):
         w = e[key]
@@ -55,10 +39,119 @@ def Matcher(case='smartcase', key='abbr', **kargs):
         e['user_data']['match_highlight'] = [[i, i + len(b)]]
         return True
 
+    def match_many_smart_case(b, matches, infos=None):
+        if not b:
+            return (list(range(len(matches))),
+                    [dict(match_highlight=[])] * len(matches))
+
+        # casefolded substring is necessary for a smartcase match, the
+        # exact check only runs on the candidates found in the block
+        words = [e[key] for e in matches]
+        indices = []
+        results = []
+        for i, _ in block_find(b.casefold(), words, str.casefold):
+            p = smart_case_find(b, words[i])
+            if p == -1:
+                continue
+            indices.append(i)
+            results.append(result(p, b))
+        return indices, results
+
+    def match_many_case(b, matches, infos=None):
+        words = [e[key] for e in matches]
+        return many(block_find(b, words), b)
+
+    def match_many_icase(b, matches, infos=None):
+        words = [e[key] for e in matches]
+        return many(block_find(b.lower(), words, str.lower), b)
+
+    def many(found, b):
+        indices = []
+        results = []
+        for i, p in found:
+            indices.append(i)
+            results.append(result(p, b))
+        return indices, results
+
+    def result(p, b):
+        return dict(match_key=key, match_highlight=[[p, p + len(b)]])
+
     if case == 'smartcase':
-        return match_smart_case
+        match = match_smart_case
+        match.match_many = match_many_smart_case
     elif case == 'icase':
-        return match_icase
+        match = match_icase
+        match.match_many = match_many_icase
+    else:
+        match = match_case
+        match.match_many = match_many_case
+
+    # a match of the base implies a match of the base's prefix
+    match.monotonic = True
+    return match
+
+
+def smart_case_find(b, w):
+    lw = len(w)
+    lb = len(b)
+
+    if lb > lw:
+        return -1
+
+    if not lb:
+        return 0
+
+    for i in range(lw - lb + 1):
+        match = True
+        sw = w[i: i + lb]
+        for cb, cw in zip(b, sw):
+            if cb == cw:
+                continue
+            if cb.lower() != cw.lower():
+                match = False
+                break
+            if cb.islower():
+                continue
+            else:
+                match = False
+                break
+        if match:
+            return i
+
+    return -1
+
+
+def block_find(b, words, conv=None):
+    """
+    Yield (index, position) of the first occurrence of b in each of the
+    words. The words are joined into one block so that a single str.find()
+    scan skips the candidates that don't contain b. With conv, the block
+    is converted (e.g. str.lower) before searching, the positions are
+    relative to the converted words.
+    """
+    block = '\0'.join(words)
+
+    if '\0' in b or not b or block.count('\0') != len(words) - 1:
+        for i, w in enumerate(words):
+            if conv:
+                w = conv(w)
+            p = w.find(b)
+            if p != -1:
+                yield i, p
+        return
+
+    if conv:
+        block = conv(block)
+        lens = map(len, block.split('\0'))
     else:
-        return match_case
+        lens = map(len, words)
+    # the start of the next word
+    nexts = list(accumulate(map((1).__add__, lens)))
 
+    # b has no '\0', a hit never crosses the separator
+    p = block.find(b)
+    while p != -1:
+        i = bisect_right(nexts, p)
+        start = nexts[i - 1] if i else 0
+        yield i, p - start
+        p = block.find(b, nexts[i])
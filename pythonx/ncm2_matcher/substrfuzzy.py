@@ -1,69 +1,40 @@
-import re
-from functools import reduce
+from bisect import bisect_left
+from ncm2 import get_abbrev, match_pattern, match_many_by_info, str_fold
+from ncm2 import MatchInfo
+# the case of fuzzy_match(b, s, chcmp) calls
+from ncm2 import chcmp_smartcase, chcmp_case, chcmp_icase  # noqa: F401
 
 
-def chcmp_smartcase(a, b): return a == b if a.isupper() else a == b.lower()
-
-
-def chcmp_case(a, b): return a == b
-
-
-def chcmp_icase(a, b): return a.lower() == b.lower()
-
-
-def fuzzy_match(b, s, chcmp):
+def fuzzy_match(b, s, case, info=None):
     if len(b) == 0:
         return []
     if len(s) == 0:
         return None
-    abbrs = get_abbrev(s)
-    return substr_fuzzy_match(b, s, abbrs, chcmp)
-
-
-def get_abbrev(s):
-    res = []
-    if len(s) == 0:
-        return res
-    # always append 0 so that it should also detects prefix match
-    res.append(0)
-    for i in range(1, len(s)):
-        cp = s[i - 1]
-        c = s[i]
-        if not c.isalpha():
-            if c.isdecimal() and not cp.isdecimal():
-                res.append(i)
-            continue
-        elif not cp.isalpha():
-            res.append(i)
-            continue
-        elif c.isupper() and not cp.isupper():
-            res.append(i)
-            continue
-        else:
-            continue
-    return res
-
-
-def abbrs_ge(abbrs, ge):
-    for i, e in enumerate(abbrs):
-        if e >= ge:
-            return abbrs[i:]
-    return []
-
-
-def substr_fuzzy_match(b, s, abbrs, chcmp):
+    if info is None:
+        info = MatchInfo(s)
+    pat = match_pattern(b, case)
+    return substr_fuzzy_match(pat, 0, s, info.folded, info.abbrev, 0,
+                              info.positions())
+
+
+def substr_fuzzy_match(pat, bi, s, f, abbrs, ai, positions):
+    """
+    Match pat[bi:] against s, starting from the boundaries abbrs[ai:].
+    positions is MatchInfo.positions() of s.
+    """
     end = len(s)
-    start = abbrs[0]
+    start = abbrs[ai]
     while end > start:
-        pos, l = max_substr_match(b, s, [start, end], chcmp)
+        pos, l = max_substr_match(pat, bi, s, f, start, end, positions)
         if not l:
             return None
         highlight = [pos, pos + l]
-        if l == len(b):
+        if l == len(pat) - bi:
             return [highlight]
-        sub_abbrs = abbrs_ge(abbrs, pos + l)
-        if sub_abbrs:
-            highlights = substr_fuzzy_match(b[l:], s, sub_abbrs, chcmp)
+        sub_ai = bisect_left(abbrs, pos + l, ai)
+        if sub_ai < len(abbrs):
+            highlights = substr_fuzzy_match(pat, bi + l, s, f, abbrs, sub_ai,
+                                            positions)
             if highlights:
                 return [highlight] + highlights
         if l == 1:
@@ -73,43 +44,65 @@ def substr_fuzzy_match(b, s, abbrs, chcmp):
     return None
 
 
-def max_substr_match(b, s, sec, chcmp):
+def max_substr_match(pat, bi, s, f, start, end, positions):
+    """
+    The first longest common prefix of pat[bi:] and s[i:], for i in [start,
+    end). Only the positions of the first character are tried.
+    """
     max_i = 0
     max_l = 0
-    for i in range(sec[0], sec[1]):
-        l = 0
-        for c1, c2 in zip(b, s[i:]):
-            if chcmp(c1, c2):
-                l += 1
-            else:
-                break
+    c, raw = pat[bi]
+    ps = positions.get(str_fold(c) if raw else c, ())
+    lo = bisect_left(ps, start)
+    hi = bisect_left(ps, end, lo)
+    rest = len(pat) - bi
+    for i in ps[lo: hi]:
+        if raw and s[i] != c:
+            continue
+        l = common_prefix_len(pat, bi, s, f, i)
         if l > max_l:
             max_l = l
             max_i = i
+            if l == rest:
+                break
     return max_i, max_l
 
 
-def Matcher(case='smartcase', key='abbr', **kargs):
+def common_prefix_len(pat, bi, s, f, p):
+    l = 0
+    for c, raw in pat[bi: bi + len(s) - p]:
+        if (s if raw else f)[p + l] != c:
+            break
+        l += 1
+    return l
+
 
-    if case == 'smartcase':
-        chcmp = chcmp_smartcase
-    elif case == 'icase':
-        chcmp = chcmp_icase
-    else:
-        chcmp = chcmp_case
+def Matcher(case='smartcase', key='abbr', **kargs):
 
     def match(b, m):
-        hl = fuzzy_match(b, m[key], chcmp)
+        hl = fuzzy_match(b, m[key], case)
         if hl is None:
             return False
         m['user_data']['match_key'] = key
         m['user_data']['match_highlight'] = hl
         return True
 
+    def match_info(pat, s, info):
+        hl = substr_fuzzy_match(pat, 0, s, info.folded, info.abbrev, 0,
+                                info.positions())
+        if hl is None:
+            return None
+        return dict(match_key=key, match_highlight=hl)
+
+    match.match_many = match_many_by_info(match_info, key, case)
+    # a match of the base implies a match of the base's prefix
+    match.monotonic = True
+    # the matched candidates have all the characters of the base
+    match.prefilter_key = key
     return match
 
 
-def test_fuzzy_match(b, s, chcmp):
+def test_fuzzy_match(b, s, case):
     print('base : ' + b)
 
     res = get_abbrev(s)
@@ -119,7 +112,7 @@ def test_fuzzy_match(b, s, chcmp):
     print('split: ' + ''.join(ls))
     print('str  : ' + s)
 
-    highlights = fuzzy_match(b, s, chcmp)
+    highlights = fuzzy_match(b, s, case)
     s2 = ' ' * len(s)
     if highlights:
         for hl in highlights:
@@ -130,16 +123,16 @@ def test_fuzzy_match(b, s, chcmp):
 
 
 if __name__ == '__main__':
-    test_fuzzy_match('subfuzzy', 'substr_fuzzy_match', chcmp_smartcase)
+    test_fuzzy_match('subfuzzy', 'substr_fuzzy_match', 'smartcase')
     print('')
     test_fuzzy_match(
-        'substrfuzzy', 'substr_substrfuzzy_match', chcmp_smartcase)
+        'substrfuzzy', 'substr_substrfuzzy_match', 'smartcase')
     print('')
-    test_fuzzy_match('sfum', 'substr_substrfuzzy_match', chcmp_smartcase)
+    test_fuzzy_match('sfum', 'substr_substrfuzzy_match', 'smartcase')
     print('')
-    test_fuzzy_match('sfuym', 'substr_substrfuzzy_match', chcmp_smartcase)
+    test_fuzzy_match('sfuym', 'substr_substrfuzzy_match', 'smartcase')
     print('')
-    test_fuzzy_match('abcfoo', 'abc_foo_abcf', chcmp_smartcase)
+    test_fuzzy_match('abcfoo', 'abc_foo_abcf', 'smartcase')
     print('')
-    test_fuzzy_match('abcfoo', 'a_b_c_abc_abfoo', chcmp_smartcase)
+    test_fuzzy_match('abcfoo', 'a_b_c_abc_abfoo', 'smartcase')
     print('')
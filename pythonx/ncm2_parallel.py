@@ -0,0 +1,192 @@
+# -*- coding: utf-8 -*-
+"""
+Parallel matching of large candidate sets in a pool of worker processes.
+
+The matched field of the candidates is copied once per source response
+into a shared memory block, the workers decode it once and keep it with
+the MatchInfos of the candidates, so that a keystroke only sends the base,
+the matcher options and the positions of the candidates to match.
+"""
+
+import os
+import json
+import atexit
+import multiprocessing
+from collections import OrderedDict
+from ncm2 import getLogger, matcher_get, matcher_many, matcher_opt_formalize
+from ncm2 import MatchInfos
+
+try:
+    from multiprocessing import shared_memory
+except ImportError:
+    shared_memory = None
+
+logger = getLogger(__name__)
+
+# the builtin matchers, their match_many only reads the matched field
+MATCHERS = {'prefix', 'substr', 'abbrfuzzy', 'substrfuzzy', 'fzy', 'combine'}
+
+# the pools and the shared blocks that are not closed yet
+_opened = set()
+
+
+@atexit.register
+def close_all():
+    for o in list(_opened):
+        o.close()
+
+
+def supported(opt, key=None):
+    """
+    Whether the matcher could run in the workers. The workers are forked,
+    so it's unix only. The workers only have the matched field of the
+    candidates, the sub-matchers of combine must match the same one.
+    """
+    if shared_memory is None or not hasattr(os, 'fork'):
+        return False
+    if opt['name'] not in MATCHERS:
+        return False
+    if key is None:
+        key = matcher_key(opt)
+    elif opt.get('key', key) != key:
+        return False
+    return all(supported(matcher_opt_formalize(m), key)
+               for m in opt.get('matchers', []))
+
+
+def matcher_key(opt):
+    return opt.get('key', 'abbr')
+
+
+class SharedMatches:
+    """
+    The matched field of the candidates of a source in a shared memory
+    block, utf-8 encoded and joined by '\\0'.
+    """
+
+    def __init__(self, key, matches):
+        words = [m[key] for m in matches]
+        if any('\0' in w for w in words):
+            raise ValueError('the candidates contain \\0')
+        data = '\0'.join(words).encode()
+        self.size = len(data)
+        self.shm = shared_memory.SharedMemory(create=True,
+                                              size=max(self.size, 1))
+        self.shm.buf[: self.size] = data
+        _opened.add(self)
+        self.name = self.shm.name
+        self.key = key
+        # the position of each candidate in the block, the matches are kept
+        # so that the ids stay valid
+        self.matches = matches
+        self.ids = {id(m): i for i, m in enumerate(matches)}
+
+    def positions(self, matches):
+        """
+        The positions in the block of the leading matches that are in it.
+        The matches appended by the source later follow the ones in the
+        block.
+        """
+        ids = self.ids
+        if matches is self.matches:
+            return range(len(matches))
+        positions = []
+        for m in matches:
+            p = ids.get(id(m), None)
+            if p is None:
+                break
+            positions.append(p)
+        return positions
+
+    def close(self):
+        if self.shm:
+            _opened.discard(self)
+            self.shm.close()
+            self.shm.unlink()
+            self.shm = None
+
+
+class Pool:
+    """
+    A pool of forked worker processes for match_many.
+    """
+
+    def __init__(self, workers):
+        ctx = multiprocessing.get_context('fork')
+        self.workers = workers
+        self.pool = ctx.Pool(workers)
+        _opened.add(self)
+
+    def match_many(self, shared, opt, b, positions):
+        """
+        Match the candidates at positions of the shared block. Returns
+        (indices, results) like match_many, the indices are positions in
+        the positions list.
+        """
+        n = len(positions)
+        if n == 0:
+            return [], []
+        step = -(-n // self.workers)
+        chunks = [positions[i: i + step] for i in range(0, n, step)]
+        opt = json.dumps(opt, sort_keys=True)
+        args = [(shared.name, shared.size, opt, b, chunk)
+                for chunk in chunks]
+        indices = []
+        results = []
+        offset = 0
+        for chunk, (idx, res) in zip(chunks,
+                                     self.pool.starmap(worker_match, args)):
+            indices += [offset + i for i in idx]
+            results += res
+            offset += len(chunk)
+        return indices, results
+
+    def close(self):
+        if self.pool:
+            _opened.discard(self)
+            self.pool.terminate()
+            self.pool = None
+
+
+# the decoded blocks of a worker, with the MatchInfos of the candidates
+_blocks = OrderedDict()
+_blocks_max = 4
+_matchers = {}
+
+
+def worker_block(name, size):
+    """
+    The candidates of the block, the candidate items built for each matched
+    field, and the MatchInfos.
+    """
+    block = _blocks.get(name, None)
+    if block is None:
+        shm = shared_memory.SharedMemory(name=name)
+        try:
+            words = bytes(shm.buf[: size]).decode().split('\0')
+        finally:
+            shm.close()
+        block = (words, {}, MatchInfos())
+        _blocks[name] = block
+        if len(_blocks) > _blocks_max:
+            _blocks.popitem(last=False)
+    else:
+        _blocks.move_to_end(name)
+    return block
+
+
+def worker_match(name, size, opt, b, positions):
+    if opt not in _matchers:
+        mopt = json.loads(opt)
+        _matchers[opt] = (matcher_many(matcher_get(mopt)), matcher_key(mopt))
+    many, key = _matchers[opt]
+    words, items, infos = worker_block(name, size)
+    items = items.setdefault(key, {})
+    matches = []
+    for p in positions:
+        m = items.get(p, None)
+        if m is None:
+            m = {key: words[p]}
+            items[p] = m
+        matches.append(m)
+    return many(b, matches, infos)
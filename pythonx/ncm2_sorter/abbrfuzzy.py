@@ -1,4 +1,5 @@
 import sys
+import heapq
 
 def Sorter(**kargs):
     def key(e):
@@ -24,8 +25,14 @@ def Sorter(**kargs):
 
         return [pieces, first_match, span, scw]
 
-    def sort(matches: list):
+    def sort(matches: list, limit=-1):
+        # the same order as sorted(), only the first limit items are kept
+        if 0 <= limit < len(matches):
+            return heapq.nsmallest(limit, matches, key=key)
         matches.sort(key=key)
         return matches
 
+    # for merging the sorted matches of different sources
+    sort.key = key
+
     return sort
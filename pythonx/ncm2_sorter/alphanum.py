@@ -1,7 +1,16 @@
+import heapq
 
 def Sorter(**kargs):
-    def sort(matches: list):
-        matches.sort(key=lambda e: e['word'].swapcase())
+    def key(e):
+        return e['word'].swapcase()
+
+    def sort(matches: list, limit=-1):
+        # the same order as sorted(), only the first limit items are kept
+        if 0 <= limit < len(matches):
+            return heapq.nsmallest(limit, matches, key=key)
+        matches.sort(key=key)
         return matches
-    return sort
 
+    # for merging the sorted matches of different sources
+    sort.key = key
+    return sort
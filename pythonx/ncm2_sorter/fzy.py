@@ -0,0 +1,19 @@
+import heapq
+
+def Sorter(**kargs):
+    def key(e):
+        w = e['word']
+        # higher score first, then the shorter one
+        score = e['user_data'].get('match_score', 0)
+        return [-score, len(w), w.swapcase()]
+
+    def sort(matches: list, limit=-1):
+        # the same order as sorted(), only the first limit items are kept
+        if 0 <= limit < len(matches):
+            return heapq.nsmallest(limit, matches, key=key)
+        matches.sort(key=key)
+        return matches
+
+    # for merging the sorted matches of different sources
+    sort.key = key
+    return sort
@@ -0,0 +1,47 @@
+import os
+import sys
+import types
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'pythonx'))
+os.environ['NVIM_YARP_MODULE'] = 'ncm2_core'
+
+# ncm2 imports the client as neovim, which newer hosts only have as pynvim.
+# The tests don't talk to a nvim, so neither is required
+try:
+    import neovim  # noqa: F401
+except ImportError:
+    try:
+        import pynvim
+        sys.modules['neovim'] = pynvim
+    except ImportError:
+        neovim = types.ModuleType('neovim')
+        neovim.attach = neovim.setup_logging = lambda *args, **kwargs: None
+        sys.modules['neovim'] = neovim
+
+# the vim module of the yarp host, the calls are recorded
+vim = types.ModuleType('vim')
+vim.calls = []
+vim.call = lambda *args, **kwargs: vim.calls.append(args)
+vim.async_call = lambda fn: fn()
+sys.modules.setdefault('vim', vim)
+
+
+@pytest.fixture
+def core():
+    import ncm2_core
+    core = ncm2_core.ncm2_core
+    core.cache_cleanup()
+    core._popup_sent = None
+    core._popup_seq = 0
+    core._pool_failed.clear()
+    sys.modules['vim'].calls.clear()
+    yield core
+    core.cache_cleanup()
+    core.pool_close()
+
+
+@pytest.fixture
+def calls():
+    return sys.modules['vim'].calls
@@ -0,0 +1,36 @@
+def src(name, **kw):
+    sr = dict(name=name, enable=1, ready=1, priority=5, auto_popup=1,
+              early_cache=0, subscope_enable=0)
+    sr.update(kw)
+    return sr
+
+
+def data(typed, sources, **kw):
+    ctx = dict(bufnr=1, curpos=[0, 1, len(typed) + 1, 0], changedtick=1,
+               lnum=1, bcol=len(typed.encode()) + 1, ccol=len(typed) + 1,
+               filetype='python', scope='python', filepath='', typed=typed,
+               tick=[[0, 1, len(typed) + 1], 0], context_id=len(typed))
+    d = dict(auto_popup=1, skip_tick=[], complete_length=[[1, 3], [7, 2]],
+             matcher='abbrfuzzy', sorter='abbrfuzzy', filter=[],
+             popup_limit=-1, context=ctx, sources=sources,
+             subscope_detectors={}, lines=[])
+    d.update(kw)
+    return d
+
+
+def complete(core, calls, typed, sources, results, **kw):
+    """
+    Notify the sources for typed, and answer with results[name].
+    """
+    core.on_complete(data(typed, sources, **kw), 0)
+    notified = [n['context'] for c in calls
+                if c[0] == 'ncm2#_notify_complete' for n in c[2]]
+    for sctx in notified:
+        sctx['dated'] = 0
+        core.complete(data(typed, sources, **kw), sctx, sctx['startccol'],
+                      list(results[sctx['source']['name']]), 0)
+
+
+def last_popup(calls):
+    popups = [c for c in calls if c[0] == 'ncm2#_update_matches']
+    return [(m['word'], m['menu']) for m in popups[-1][3]]
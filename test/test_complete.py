@@ -0,0 +1,83 @@
+import json
+import sys
+import types
+
+from helpers import src, data, complete, last_popup
+
+
+def test_total_popup_limit(core, calls):
+    sources = {'a': src('a'), 'b': src('b', mark='b')}
+    results = {
+        'a': ['foo%03d' % i for i in range(200)],
+        'b': ['fo_o%03d' % i for i in range(200)] + ['foo'],
+    }
+    complete(core, calls, 'x foo', sources, results)
+    full = last_popup(calls)
+    assert {menu for _, menu in full} == {'', '[b] '}
+
+    for total in (0, 1, 7, 150, 500):
+        core.cache_cleanup()
+        calls.clear()
+        complete(core, calls, 'x foo', sources, results,
+                 total_popup_limit=total)
+        assert last_popup(calls) == full[:total]
+
+
+def test_total_popup_limit_copies(core, calls, monkeypatch):
+    copied = []
+    matches_copy = core.matches_copy
+    monkeypatch.setattr(core, 'matches_copy',
+                        lambda ms, *args: copied.append(len(ms)) or
+                        matches_copy(ms, *args))
+    sources = {'a': src('a'), 'b': src('b')}
+    results = {'a': ['foo%03d' % i for i in range(200)],
+               'b': ['fo_o%03d' % i for i in range(200)]}
+    complete(core, calls, 'x foo', sources, results, total_popup_limit=7)
+    assert copied and max(copied) == 7
+
+
+def test_total_popup_limit_filter(core, calls):
+    sources = {'a': src('a', popup_limit=3)}
+    results = {'a': ['foo', 'foo1', 'foo', 'foo22', 'foo333']}
+    complete(core, calls, 'x foo', sources, results, filter=['same_word'],
+             total_popup_limit=2)
+    assert last_popup(calls) == [('foo1', ''), ('foo22', '')]
+
+
+def test_popup_not_resent(core, calls):
+    sources = {'a': src('a'), 'b': src('b')}
+    results = {'a': ['foo', 'foo1'], 'b': []}
+    complete(core, calls, 'x foo', sources, results)
+    popups = [c for c in calls if c[0] == 'ncm2#_update_matches']
+    assert [len(c[3]) for c in popups] == [0, 2]
+
+    # with the adaptive delay vim is told that no source is late anymore
+    core.cache_cleanup()
+    calls.clear()
+    complete(core, calls, 'x foo', sources, results, popup_delay_adaptive=1)
+    popups = [c for c in calls if c[0] == 'ncm2#_update_matches']
+    assert [len(c[3]) for c in popups] == [0, 2, 2]
+    assert popups[-1][4] == 0
+
+
+def test_filter_nested_user_data(core, calls, monkeypatch):
+    def Filter(**kargs):
+        def filt(data, sr, sctx, sccol, matches):
+            for m in matches:
+                m['user_data']['lsp']['typed'] = data['context']['typed']
+            return matches
+        return filt
+
+    mod = types.ModuleType('ncm2_filter.nested')
+    mod.Filter = Filter
+    monkeypatch.setitem(sys.modules, 'ncm2_filter.nested', mod)
+    sources = {'a': src('a')}
+    results = {'a': [dict(word='foobar', user_data=dict(lsp=dict(kind=3)))]}
+    complete(core, calls, 'x foo', sources, results, filter=['nested'])
+    core.on_complete(data('x foob', sources, filter=['nested']), 0)
+
+    popups = [c for c in calls if c[0] == 'ncm2#_update_matches']
+    sent = [json.loads(c[3][0]['user_data'])['lsp'] for c in popups[-2:]]
+    assert sent == [dict(kind=3, typed='x foo'), dict(kind=3, typed='x foob')]
+    cached, = core._matches['a']['matches']
+    assert cached['user_data']['lsp'] == dict(kind=3)
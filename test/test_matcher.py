@@ -0,0 +1,25 @@
+import pytest
+
+from ncm2_matcher import abbrfuzzy, substrfuzzy
+
+
+@pytest.mark.parametrize('mod', [abbrfuzzy, substrfuzzy])
+@pytest.mark.parametrize('b,s', [
+    ('abbrfuzzy', 'abbr_fuzzy_match'),
+    ('afm', 'abbr_fuzzy_match'),
+    ('AFM', 'abbr_fuzzy_match'),
+    ('gfn', 'getFieldByName'),
+    ('gFN', 'getFieldByName'),
+    ('xyz', 'abbr_fuzzy_match'),
+    ('', 'foo'),
+])
+def test_fuzzy_match_chcmp(mod, b, s):
+    for chcmp, case in [(mod.chcmp_smartcase, 'smartcase'),
+                        (mod.chcmp_case, 'case'),
+                        (mod.chcmp_icase, 'icase')]:
+        assert mod.fuzzy_match(b, s, chcmp) == mod.fuzzy_match(b, s, case)
+
+
+def test_fuzzy_match_chcmp_unknown():
+    with pytest.raises(ValueError):
+        abbrfuzzy.fuzzy_match('f', 'foo', lambda a, b: a == b)
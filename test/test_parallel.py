@@ -0,0 +1,106 @@
+import pytest
+
+import ncm2_parallel
+
+from helpers import src, data, complete, last_popup
+
+pytestmark = pytest.mark.skipif(
+    not ncm2_parallel.supported(dict(name='abbrfuzzy')),
+    reason='no fork or shared_memory')
+
+
+def test_pool_close():
+    pool = ncm2_parallel.Pool(2)
+    assert pool in ncm2_parallel._opened
+    assert pool.match_many(None, dict(name='prefix'), 'f', []) == ([], [])
+    pool.close()
+    pool.close()
+    assert pool not in ncm2_parallel._opened
+
+
+def test_shared_close():
+    shared = ncm2_parallel.SharedMatches('abbr', [dict(abbr='foo')])
+    assert shared in ncm2_parallel._opened
+    shared.close()
+    shared.close()
+    assert shared not in ncm2_parallel._opened
+
+
+def test_parallel_matches(core, calls):
+    sources = {'a': src('a'), 'b': src('b')}
+    results = {'a': ['foo%03d' % i for i in range(100)], 'b': []}
+    complete(core, calls, 'x foo', sources, results)
+    serial = last_popup(calls)
+
+    core.cache_cleanup()
+    calls.clear()
+    complete(core, calls, 'x foo', sources, results, parallel_threshold=0,
+             parallel_workers=2)
+    assert last_popup(calls) == serial
+    assert core._pool is not None
+    shared = core._matches['a']['shared']
+    assert core._matches['b']['shared'] is None
+
+    # the shared blocks are closed with the cache
+    core.cache_cleanup()
+    assert shared not in ncm2_parallel._opened
+
+
+def test_supported_combine_key():
+    combine = dict(name='combine', matchers=['prefix', 'substr'])
+    assert ncm2_parallel.supported(combine)
+    assert ncm2_parallel.supported(dict(combine, key='word'))
+    combine['matchers'].append(dict(name='substr', key='word'))
+    assert not ncm2_parallel.supported(combine)
+    assert ncm2_parallel.supported(dict(combine, key='word'))
+
+
+def test_parallel_failed(core, calls, monkeypatch):
+    failed = []
+
+    class Pool:
+        def match_many(self, *args):
+            failed.append(args)
+            raise RuntimeError('failed')
+
+    monkeypatch.setattr(core, 'pool_get', lambda data: Pool())
+    sources = {'a': src('a')}
+    results = {'a': ['foo%03d' % i for i in range(100)]}
+    kw = dict(parallel_threshold=0, parallel_workers=2)
+    complete(core, calls, 'x foo', sources, results, **kw)
+    assert len(failed) == 1
+    assert len(last_popup(calls)) == 100
+
+    # the matcher isn't tried in the workers again
+    core.on_complete(data('x foo099', sources, **kw), 0)
+    assert len(failed) == 1
+    assert last_popup(calls) == [('foo099', '')]
+
+
+def test_parallel_append(core, calls, monkeypatch):
+    sources = {'a': src('a')}
+    kw = dict(parallel_threshold=10, parallel_workers=2)
+    complete(core, calls, 'x foo', sources,
+             {'a': ['foo%03d' % i for i in range(100)]}, **kw)
+    sctx = core._matches['a']['context']
+    core.complete(data('x foo', sources, **kw), sctx, sctx['startccol'],
+                  ['foox%03d' % i for i in range(20)], 0, 1)
+
+    pooled = []
+    pool_get = core.pool_get
+
+    def pool_get_count(data):
+        pool = pool_get(data)
+        match_many = pool.match_many
+
+        class Pool:
+            def match_many(self, shared, opt, b, positions):
+                pooled.append(len(positions))
+                return match_many(shared, opt, b, positions)
+        return Pool()
+
+    monkeypatch.setattr(core, 'pool_get', pool_get_count)
+    calls.clear()
+    core.on_complete(data('x foo0', sources, **kw), 0)
+    assert pooled == [100]
+    assert len(last_popup(calls)) == 120
@@ -0,0 +1,73 @@
+def ctx(typed='x fo', tick=1):
+    return dict(typed=typed, tick=[[0, 1, len(typed) + 1], tick])
+
+
+def item(word, **fields):
+    m = dict(word=word, abbr=word, menu='', info='', kind='', icase=1,
+             user_data=dict(source='a', ncm2=1))
+    m.update(fields)
+    return m
+
+
+def words(matches):
+    return [m['word'] for m in matches]
+
+
+def popups(calls):
+    return [c[1:] for c in calls if c[0] == 'ncm2#_update_matches']
+
+
+def test_item_key_unhashable(core):
+    m = item('foo', info=['a', 'b'], user_data='{}')
+    key = core.popup_item_key(m)
+    hash(key)
+    assert key == core.popup_item_key(dict(m))
+    assert key != core.popup_item_key(item('foo', info=['a'], user_data='{}'))
+
+
+def test_popup_unhashable(core, calls):
+    matches = [item('foo', dup=[1]), item('fob', lsp=dict(kind=3))]
+    core.matches_do_popup(ctx(), 3, matches)
+    sent, = popups(calls)
+    assert sent[2] == matches
+
+    # the same popup isn't sent again
+    core.matches_do_popup(ctx(), 3, [item('foo', dup=[1]),
+                                     item('fob', lsp=dict(kind=3))])
+    assert len(popups(calls)) == 1
+
+
+def test_popup_delta(core, calls):
+    core.matches_do_popup(ctx(), 3, [item('foo', dup=[1]), item('fob')],
+                          delta=1)
+    core.matches_do_popup(ctx(tick=2), 3,
+                          [item('fob'), item('foo', dup=[1]),
+                           item('fob', info='doc'), item('fox')],
+                          delta=1)
+    first, second = popups(calls)
+    assert first[4:] == (1, -1)
+    assert second[4:] == (2, 1)
+    ops = second[2]
+    assert ops[:2] == [1, 0]
+    assert ops[2] == [1, dict(info='doc')]
+    assert ops[3]['word'] == 'fox'
+
+
+def test_popup_resync(core, calls):
+    matches = [item('foo', dup=[1]), item('fob')]
+    core.matches_do_popup(ctx(), 3, matches, delta=1)
+    core.matches_do_popup(ctx(tick=2), 3, [item('fob')], delta=1)
+    core.popup_resync({})
+    *_, resync = popups(calls)
+    assert words(resync[2]) == ['fob']
+    assert resync[4:] == (2, -1)
+
+
+def test_popup_no_delta(core, calls):
+    core.matches_do_popup(ctx(), 3, [item('foo')], delta=1)
+    core.matches_do_popup(ctx(tick=2), 3, [item('fob')])
+    core.popup_resync({})
+    _, full = popups(calls)
+    assert words(full[2]) == ['fob']
+    assert len(full) == 4
+    assert len(popups(calls)) == 2
@@ -0,0 +1,23 @@
+import pytest
+
+from ncm2_core import line_word_edit
+
+
+@pytest.mark.parametrize('old,ocur,new,ncur,edit', [
+    # typing a word after a space
+    ('foo ba', 6, 'foo bar', 7, True),
+    ('    x = ba', 10, '    x = bar', 11, True),
+    # a word before a boundary at the line start
+    ('py```', 2, 'pyt```', 3, False),
+    ('ab', 2, 'abc', 3, False),
+    # a word alone on its line may be a boundary, e.g. a heredoc terminator
+    ('EO', 2, 'EOF', 3, False),
+    ('  endsnippe', 11, '  endsnippet', 12, False),
+    ('', 0, 'E', 1, False),
+    # a non-word character may complete a boundary
+    ('foo', 3, 'foo`', 4, False),
+    ('<script', 7, '<script>', 8, False),
+    ('<scrip', 6, '<script', 7, True),
+])
+def test_line_word_edit(old, ocur, new, ncur, edit):
+    assert line_word_edit(old, ocur, new, ncur) == edit
@@ -0,0 +1,39 @@
+import random
+import re
+
+import pytest
+
+
+def word_start(pat, typed):
+    matched = re.search('(?:%s)$' % pat, typed)
+    return matched.start() if matched else len(typed)
+
+
+@pytest.mark.parametrize('scope', ['*', 'css', 'php', 'vim'])
+def test_word_start(core, scope):
+    pat = core._word_patterns[scope]
+    rnd = random.Random(scope)
+    chars = 'ab1_-.$ :/'
+    for _ in range(2000):
+        typed = ''.join(rnd.choice(chars) for _ in range(rnd.randint(0, 12)))
+        assert core.typed_word_start(typed, pat) == word_start(pat, typed), \
+            typed
+
+
+def test_word_start_gap(core):
+    # the pattern matches 'a.b' but not '.b'
+    pat = r'a\.b|b'
+    assert core.typed_word_start('x a.b', pat) == 2
+    assert core.typed_word_start('x a.', pat) == 4
+    assert core.typed_word_start('foo ', r'\w+') == 4
+    assert core.typed_word_start('', r'\w+') == 0
+
+
+@pytest.mark.parametrize('pat,typed,base', [
+    (r'\$\w+', 'echo $HO', '$HO'),
+    (r':[\w+\-]*', 'hi :smi', ':smi'),
+    (r'\\\w*', 'foo \\al', '\\al'),
+    (r'\$\w+', 'echo $', ''),
+])
+def test_word_start_sigil(core, pat, typed, base):
+    assert typed[core.typed_word_start(typed, pat):] == base